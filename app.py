@@ -1,35 +1,195 @@
-from flask import Flask, request, render_template_string, send_from_directory, jsonify
-from randmov_html_parser import fetch_watchlist
-from qrng import qrng
+import time
+startup_started = time.perf_counter()  # Used by the startup-time report
+
+from flask import Flask, request, render_template_string, send_from_directory, send_file, jsonify, url_for, abort, Response, stream_template_string, stream_with_context, g
+from randmov_html_parser import fetch_watchlist, fetch_watchlist_iter, fetch_random_movie, refresh_watchlist
+from qrng import qrng, qrng_many, QRNG_MODE, get_entropy_pool, get_circuit
+from watchlist_store import WatchlistStore
+from watchlist_cache import WatchlistCache
+from details_cache import DetailsCache
+from details_prefetch import DetailsPrefetcher
+from watchlist_index import WatchlistIndex
+from concurrency import run_cpu_bound, native_lock
 import os
-import matplotlib
-matplotlib.use('Agg')  # Use non-interactive backend for web
-import matplotlib.pyplot as plt
 from io import BytesIO
-import base64
-import requests
+import threading
+from functools import lru_cache
+import letterboxd_http
+import metrics
+import request_profiler
+from request_profiler import profiled
 import json
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
 
+# Start filling the quantum entropy pool right away, so the first picks do not wait for it
+if QRNG_MODE == 'pool':
+    get_entropy_pool()
+
+# Watchlists loaded in this process, so the selection step does not scrape them again
+watchlist_store = WatchlistStore()
+
+# Watchlists scraped recently by any worker process, so concurrent requests for the same user share a single scrape
+watchlist_cache = WatchlistCache()
+
+# Movie details are fetched by a single pool shared by all requests, so a batch can never use more than this many connections
+DETAILS_WORKERS = int(os.environ.get('RANDMOV_DETAILS_WORKERS', 8))
+details_executor = ThreadPoolExecutor(max_workers=DETAILS_WORKERS)
+
+# Director, year and runtime of every movie looked up, shared by all worker processes
+details_cache = DetailsCache()
+
+# Send the watchlist to the browser as its pages arrive, instead of waiting for all of them
+STREAM_WATCHLIST = os.environ.get('RANDMOV_STREAM_WATCHLIST', '1') == '1'
+
+# Maximum number of movies accepted by a single /get_movie_details_batch request
+DETAILS_BATCH_MAX = 100
+
+# Movies of a streamed watchlist handed to the details prefetch at a time (about a watchlist page)
+PREFETCH_CHUNK = 28
+
+# Most missing movie details a single /pick_filtered request hands to the background prefetch
+FILTER_PREFETCH_MAX = 200
+
+# Quantum circuit diagrams: format used by the page, supported formats, largest circuit drawn, number of diagrams kept in memory and browser cache lifetime (seconds)
+CIRCUIT_IMAGE_FORMAT = os.environ.get('RANDMOV_CIRCUIT_IMAGE_FORMAT', 'png')
+CIRCUIT_IMAGE_MIMETYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+CIRCUIT_IMAGE_MAX_QUBITS = 28
+CIRCUIT_IMAGE_CACHE_SIZE = 64
+CIRCUIT_IMAGE_MAX_AGE = 365 * 24 * 3600
+circuit_render_lock = native_lock()
+circuit_image_formats_drawn = set()  # Formats drawn at least once in this process
+
 # Create static directory for images if it doesn't exist
 os.makedirs('static', exist_ok=True)
 
+# Movie details endpoints as found in watchlist pages. The browser sends them back, so only these are ever fetched
+DETAILS_ENDPOINT_PATTERN = re.compile(r'^/film/(?!\.\.?/)[^/?#]+/json/$')
+
+def is_details_endpoint(json_endpoint):
+    """Whether a value sent by the browser is a Letterboxd movie details endpoint"""
+    return isinstance(json_endpoint, str) and DETAILS_ENDPOINT_PATTERN.match(json_endpoint) is not None
+
 def fetch_movie_details(json_endpoint):
     """Fetch movie details from Letterboxd JSON endpoint"""
+    if not is_details_endpoint(json_endpoint):
+        return None
+
     try:
-        url = f"https://letterboxd.com{json_endpoint}"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        }
-        response = requests.get(url, headers=headers, timeout=10)
+        with metrics.timer('randmov_movie_details_fetch_seconds'):
+            response = letterboxd_http.get(json_endpoint, timeout=10, endpoint='movie_details')
+        metrics.inc('randmov_movie_details_fetches_total', result='ok' if response.status_code == 200 else str(response.status_code))
         if response.status_code == 200:
             return response.json()
         return None
+    except letterboxd_http.ThrottledError as e:
+        # Nothing is cached, so the details are fetched again on the next request
+        metrics.inc('randmov_movie_details_fetches_total', result='throttled')
+        print(f"Error fetching movie details: {e}")
+        return None
     except Exception as e:
+        metrics.inc('randmov_movie_details_fetches_total', result='error')
         print(f"Error fetching movie details: {e}")
         return None
 
+def summarize_movie_details(movie_details):
+    """Keep the director, year and runtime from the Letterboxd movie details"""
+    return {
+        'director': movie_details.get('directors', [{}])[0].get('name', 'Unknown') if movie_details.get('directors') else 'Unknown',
+        'year': movie_details.get('releaseYear', 'Unknown'),
+        'runtime': movie_details.get('runTime', 'Unknown')
+    }
+
+def load_movie_summary(json_endpoint):
+    """Fetch the director, year and runtime of a movie from Letterboxd and cache them (None if unavailable)"""
+    movie_details = fetch_movie_details(json_endpoint)
+    if not movie_details:
+        return None
+
+    summary = summarize_movie_details(movie_details)
+    details_cache.set(json_endpoint, summary)
+    return summary
+
+# Details of the movies of a loaded watchlist are fetched in the background, and a movie already being fetched is never fetched twice
+details_prefetcher = DetailsPrefetcher(load_movie_summary, details_cache)
+
+def get_movie_summary(json_endpoint):
+    """Get the director, year and runtime of a movie, from the details cache when possible (None if unavailable)"""
+    summary = details_cache.get(json_endpoint)
+    if summary is None:
+        # Fetch them, or wait for the fetch already in flight (e.g. the prefetch started when the watchlist was loaded)
+        summary = details_prefetcher.fetch(json_endpoint)
+
+    return summary
+
+def get_pyplot():
+    """Import matplotlib's pyplot on first use (it is slow to import and only needed to draw circuits)"""
+    import matplotlib
+    matplotlib.use('Agg')  # Use non-interactive backend for web
+    import matplotlib.pyplot as plt
+    return plt
+
+@lru_cache(maxsize=CIRCUIT_IMAGE_CACHE_SIZE)
+def render_circuit_image(num_qubits, image_format='png'):
+    """Render the diagram of the quantum circuit with the given number of qubits (once per number of qubits and format)"""
+    qc, _ = get_circuit(num_qubits)
+    plt = get_pyplot()
+
+    # pyplot keeps global state, so only one diagram is drawn at a time
+    with circuit_render_lock, metrics.timer('randmov_circuit_image_render_seconds', format=image_format):
+        # Create the circuit image using matplotlib
+        fig, ax = plt.subplots(figsize=(10, 6))
+        try:
+            qc.draw('mpl', ax=ax)
+            plt.tight_layout()
+
+            img_buffer = BytesIO()
+            fig.savefig(img_buffer, format=image_format, dpi=150, bbox_inches='tight', 
+                        facecolor='#232526', edgecolor='none')
+        finally:
+            plt.close(fig)
+
+    return img_buffer.getvalue()
+
+def prerender_circuit_images(widths=range(1, 17), image_format=None):
+    """Render the circuit diagrams for the given numbers of qubits ahead of time"""
+    for num_qubits in widths:
+        render_circuit_image(num_qubits, image_format or CIRCUIT_IMAGE_FORMAT)
+
+def get_movie_summaries(json_endpoints):
+    """Get the summaries of several movies: the cached ones are read at once, the missing ones are fetched concurrently on the shared, bounded details pool"""
+    json_endpoints = list(json_endpoints)
+    summaries = details_cache.get_many(json_endpoints)
+    missing = list(dict.fromkeys(json_endpoint for json_endpoint in json_endpoints if json_endpoint not in summaries))
+    summaries.update(zip(missing, details_executor.map(get_movie_summary, missing)))
+    return summaries
+
+def get_watchlist_index(snapshot):
+    '''
+    - Get the index over the cached details of the movies of a watchlist snapshot, and the number of movies left out because their details are not cached yet.
+    - Only reads the details cache, so a request never waits on Letterboxd: up to FILTER_PREFETCH_MAX of the missing details are handed to the background prefetch.
+    - The index is kept once every movie has details or recently failed to get them (those are left out of it, and not counted as missing);
+      until then it is rebuilt on each call, picking up what the prefetch has stored since.
+    '''
+    if snapshot.index is not None:
+        return snapshot.index, 0
+
+    json_endpoints = [movie.json for movie in snapshot.movies]
+    summaries = details_cache.get_many(json_endpoints)
+    index = WatchlistIndex([summaries.get(json_endpoint) for json_endpoint in json_endpoints])
+
+    missing = [json_endpoint for json_endpoint in dict.fromkeys(json_endpoints) if json_endpoint not in summaries]
+    failed = details_prefetcher.recently_failed(missing)
+    missing = [json_endpoint for json_endpoint in missing if json_endpoint not in failed]
+    if missing:
+        details_prefetcher.prefetch(missing[:FILTER_PREFETCH_MAX], snapshot.username)
+    else:
+        snapshot.index = index
+
+    return index, sum(1 for json_endpoint in json_endpoints if json_endpoint not in summaries and json_endpoint not in failed)
+
 HTML_FORM = '''
 <!doctype html>
 <html lang="en">
@@ -137,6 +297,7 @@ HTML_FORM = '''
           <input type="text" class="form-control" id="username" name="username" placeholder="e.g. your_username" required value="{{ request.form.username or '' }}">
         </div>
         <button type="submit" class="btn btn-primary w-100" id="submitBtn">Load Watchlist</button>
+        <button type="submit" class="btn btn-outline-success w-100 mt-2" name="step" value="quick_pick">Just Pick Any Movie From My Watchlist</button>
       </form>
       <div class="loading" id="loading">
         <div class="loading-spinner"></div>
@@ -152,6 +313,7 @@ HTML_FORM = '''
       <form method="post">
         <input type="hidden" name="username" value="{{ request.form.username }}">
         <input type="hidden" name="step" value="select">
+        <input type="hidden" name="watchlist_token" value="{{ watchlist_token or '' }}">
         
         <div class="movie-selection">
           <h5 class="text-white mb-3">Select those movies you would like to choose one at random from:</h5>          
@@ -197,9 +359,13 @@ HTML_FORM = '''
                 <button type="button" class="btn btn-outline-secondary btn-sm" onclick="clearFilters()">
                   Clear Filters
                 </button>
+                <button type="button" class="btn btn-outline-success btn-sm ms-2" id="pickFilteredBtn" onclick="pickFiltered()">
+                  Pick at Random from Filters
+                </button>
                 <span class="ms-3 text-white">
-                  Showing <span id="visibleCount">{{ movies|length }}</span> of {{ movies|length }} movies
+                  Showing <span id="visibleCount">{{ movies|length if not streaming }}</span> of <span class="watchlist-total">{{ movies|length if not streaming }}</span> movies
                 </span>
+                <div id="filteredPick" class="mt-3 text-white" style="display: none;"></div>
               </div>
             </div>
           </div>
@@ -208,7 +374,7 @@ HTML_FORM = '''
             <div class="form-check">
               <input class="form-check-input" type="checkbox" id="selectAll" onchange="toggleAllMovies()">
               <label class="form-check-label" for="selectAll">
-                <strong>Select all the movies in the watchlist ({{ movies|length }} total)</strong>
+                <strong>Select all the movies in the watchlist (<span class="watchlist-total">{{ movies|length if not streaming }}</span> total)</strong>
               </label>
             </div>
           </div>
@@ -232,12 +398,31 @@ HTML_FORM = '''
               </div>
               {% endfor %}
             </div>
+            {# Rendered after the last streamed movie, so it knows whether the scrape stopped early #}
+            {% if stream_status and stream_status.error %}
+            <div class="alert alert-warning mt-3" role="alert" id="watchlistIncomplete">
+              {{ stream_status.error }}
+              <button type="button" class="btn btn-warning btn-sm ms-2" onclick="retryWatchlist()">Load it again</button>
+            </div>
+            {% endif %}
           
                       <div class="selection-summary">
               <p class="form-check-label"><strong>Selected <span id="selectedCount">{{ selected_movies|length if selected_movies else 0 }}</span> movies:</strong></p>
               <div id="selectedMoviesList" class="selected-movies-list" style="max-height: 150px; overflow-y: auto; margin: 10px 0; display: none;">
                 <!-- Selected movies will be populated here by JavaScript -->
               </div>
+              <div class="row g-2 align-items-center mb-3">
+                <div class="col-auto">
+                  <label for="pickCount" class="form-check-label">Number of movies to pick:</label>
+                </div>
+                <div class="col-auto">
+                  <input type="number" class="form-control form-control-sm" id="pickCount" name="pick_count" min="1" value="{{ pick_count }}" style="width: 6rem;">
+                </div>
+                <div class="col-auto form-check ms-2">
+                  <input class="form-check-input" type="checkbox" id="shuffleQueue" name="shuffle_queue" {% if shuffle_queue %}checked{% endif %}>
+                  <label class="form-check-label" for="shuffleQueue">Shuffle all selected movies into a queue</label>
+                </div>
+              </div>
               <button type="submit" class="btn btn-primary" id="submitBtn" {% if not selected_movies %}disabled{% endif %}>
                 <strong>Get Random Movie from Selected</strong>
               </button>
@@ -250,15 +435,24 @@ HTML_FORM = '''
     {% if random_movie %}
     <div class="card p-4">
       <div class="movie-card text-center">
+        {% if random_movies|length > 1 %}
+        <h5 class="text-white">And the chosen movies are ...</h5>
+        <ol class="text-start movie-title">
+          {% for movie in random_movies %}
+          <li><a href="{{ movie.url }}" class="movie-link" target="_blank">{{ movie.name }}</a></li>
+          {% endfor %}
+        </ol>
+        {% else %}
         <h5 class="text-white">And the chosen movie is ...</h5
         <div class="movie-title">
           <a href="{{ random_movie.url }}" class="movie-title" target="_blank">{{ random_movie.name }}</a>
+        {% endif %}
       {% if quantum_info %}
       <div class="quantum-info text-center">
         <h5 class="text-white">Quantum Circuit Used (<strong>{{ quantum_info.num_qubits }} qubits</strong>):</h5>
         {% if circuit_image %}
         <div class="mt-3">
-          <img src="data:image/png;base64,{{ circuit_image }}" alt="Quantum Circuit" class="circuit-image">
+          <img src="{{ circuit_image }}" alt="Quantum Circuit" class="circuit-image">
         </div>
         {% endif %}
       </div>
@@ -329,62 +523,92 @@ HTML_FORM = '''
       });
     }
     
-    function fetchMovieDetails(movieIndex, jsonEndpoint, detailsElement) {
-      fetch('/get_movie_details', {
+    // Movie details are requested in batches, with a few batches in flight at a time
+    const DETAILS_BATCH_SIZE = 25;
+    const DETAILS_BATCHES_IN_FLIGHT = 2;
+    
+    function showMovieDetails(movieIndex, data, detailsElement) {
+      if (data.success) {
+        const director = data.director !== 'Unknown' ? data.director : 'Unknown Director';
+        const year = data.year !== 'Unknown' ? data.year : 'Unknown Year';
+        const runtime = data.runtime !== 'Unknown' ? data.runtime : 'Unknown Runtime';
+        detailsElement.textContent = `${director} (${year}) • ${runtime} min`;
+        
+        // Store movie data for filtering
+        movieData[movieIndex] = {
+          director: director,
+          year: year,
+          runtime: runtime
+        };
+      } else {
+        detailsElement.textContent = 'Details unavailable';
+        movieData[movieIndex] = {
+          director: 'Unknown Director',
+          year: 'Unknown Year',
+          runtime: 'Unknown Runtime'
+        };
+      }
+    }
+    
+    function fetchMovieDetailsBatch(batch) {
+      return fetch('/get_movie_details_batch', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
         },
         body: JSON.stringify({
-          movie_index: movieIndex,
-          json_endpoint: jsonEndpoint
+          movies: batch.map(item => ({
+            movie_index: item.movieIndex,
+            json_endpoint: item.jsonEndpoint
+          }))
         })
       })
       .then(response => response.json())
       .then(data => {
-        if (data.success) {
-          const director = data.director !== 'Unknown' ? data.director : 'Unknown Director';
-          const year = data.year !== 'Unknown' ? data.year : 'Unknown Year';
-          const runtime = data.runtime !== 'Unknown' ? data.runtime : 'Unknown Runtime';
-          detailsElement.textContent = `${director} (${year}) • ${runtime} min`;
-          
-          // Store movie data for filtering
-          movieData[movieIndex] = {
-            director: director,
-            year: year,
-            runtime: runtime
-          };
-          
-          // Populate director filter after each successful fetch
-          populateDirectorFilter();
-        } else {
-          detailsElement.textContent = 'Details unavailable';
-          movieData[movieIndex] = {
-            director: 'Unknown Director',
-            year: 'Unknown Year',
-            runtime: 'Unknown Runtime'
-          };
-        }
+        const results = {};
+        (data.results || []).forEach(result => {
+          results[result.movie_index] = result;
+        });
+        batch.forEach(item => {
+          showMovieDetails(item.movieIndex, results[item.movieIndex] || { success: false }, item.detailsElement);
+        });
+        
+        // Populate director filter after each batch
+        populateDirectorFilter();
       })
       .catch(error => {
         console.error('Error fetching movie details:', error);
-        detailsElement.textContent = 'Details unavailable';
-        movieData[movieIndex] = {
-          director: 'Unknown Director',
-          year: 'Unknown Year',
-          runtime: 'Unknown Runtime'
-        };
+        batch.forEach(item => {
+          showMovieDetails(item.movieIndex, { success: false }, item.detailsElement);
+        });
       });
     }
     
     function loadAllMovieDetails() {
       const detailElements = document.querySelectorAll('.movie-details');
+      const items = [];
       detailElements.forEach((element, index) => {
         const jsonEndpoint = element.dataset.jsonEndpoint;
         if (jsonEndpoint) {
-          fetchMovieDetails(index, jsonEndpoint, element);
+          items.push({ movieIndex: index, jsonEndpoint: jsonEndpoint, detailsElement: element });
         }
       });
+      
+      const batches = [];
+      for (let i = 0; i < items.length; i += DETAILS_BATCH_SIZE) {
+        batches.push(items.slice(i, i + DETAILS_BATCH_SIZE));
+      }
+      
+      // Each in-flight chain picks up the next pending batch when its current one finishes
+      let nextBatch = 0;
+      function loadNextBatch() {
+        if (nextBatch < batches.length) {
+          return fetchMovieDetailsBatch(batches[nextBatch++]).then(loadNextBatch);
+        }
+      }
+      for (let i = 0; i < DETAILS_BATCHES_IN_FLIGHT; i++) {
+        loadNextBatch();
+      }
     }
     
     // Store movie data for filtering
@@ -483,6 +707,54 @@ HTML_FORM = '''
       updateSubmitButton();
     }
     
+    // Let the server pick a random movie among those matching the filters, without waiting for every movie's details to load
+    function pickFiltered() {
+      const filteredPick = document.getElementById('filteredPick');
+      const pickFilteredBtn = document.getElementById('pickFilteredBtn');
+      pickFilteredBtn.disabled = true;
+      filteredPick.style.display = 'block';
+      filteredPick.textContent = 'Picking...';
+      
+      fetch('/pick_filtered', {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({
+          watchlist_token: document.querySelector('input[name="watchlist_token"]').value,
+          director: document.getElementById('directorFilter').value,
+          decade: document.getElementById('yearFilter').value,
+          runtime: document.getElementById('runtimeFilter').value
+        })
+      })
+      .then(response => response.json())
+      .then(data => {
+        filteredPick.innerHTML = '';
+        if (data.success) {
+          const movie = data.movies[0];
+          const movieLink = document.createElement('a');
+          movieLink.href = movie.url;
+          movieLink.className = 'movie-link';
+          movieLink.target = '_blank';
+          movieLink.textContent = movie.name;
+          filteredPick.append('Chosen among ' + data.matches + ' matching movies (' + data.num_qubits + ' qubits): ');
+          filteredPick.appendChild(movieLink);
+          if (data.missing) {
+            filteredPick.append(' (' + data.missing + ' movies whose details are still loading were left out)');
+          }
+        } else {
+          filteredPick.textContent = data.error || 'Could not pick a movie';
+        }
+      })
+      .catch(error => {
+        console.error('Error picking a movie:', error);
+        filteredPick.textContent = 'Could not pick a movie';
+      })
+      .finally(() => {
+        pickFilteredBtn.disabled = false;
+      });
+    }
+    
     function clearFilters() {
       document.getElementById('directorFilter').value = '';
       document.getElementById('yearFilter').value = '';
@@ -514,6 +786,19 @@ HTML_FORM = '''
       });
     }
     
+    // Load the watchlist again after a streamed load stopped early
+    function retryWatchlist() {
+      const form = document.createElement('form');
+      form.method = 'post';
+      const username = document.createElement('input');
+      username.type = 'hidden';
+      username.name = 'username';
+      username.value = document.querySelector('input[name="username"]').value;
+      form.appendChild(username);
+      document.body.appendChild(form);
+      form.submit();
+    }
+    
     // Add event listeners to checkboxes
     document.addEventListener('DOMContentLoaded', function() {
       const checkboxes = document.querySelectorAll('.movie-checkbox');
@@ -536,7 +821,13 @@ HTML_FORM = '''
         });
       });
       
-      // Initial setup
+      // Initial setup (when the watchlist was streamed, its size is only known once the whole page has arrived)
+      const totalMovies = document.querySelectorAll('.movie-checkbox').length;
+      const incomplete = document.getElementById('watchlistIncomplete') !== null;
+      document.querySelectorAll('.watchlist-total').forEach(element => {
+        element.textContent = incomplete ? `${totalMovies}+` : totalMovies;
+      });
+      document.getElementById('visibleCount').textContent = totalMovies;
       updateSelectedCount();
       updateSubmitButton();
       updateSelectedMoviesList();
@@ -561,7 +852,42 @@ HTML_FORM = '''
 </html>
 '''
 
+def stream_watchlist(username, token, first_movie, movies_iter, fetch, status):
+    '''
+    - Yields the movies of a watchlist as they arrive, and stores its snapshot under the token (and in the shared cache) once every page is in.
+    - If the scrape fails midway, "status['error']" says so, for the page to show after the movies sent so far.
+    '''
+    movies = [first_movie]
+    yield first_movie
+
+    try:
+        # Prefetch the details of the movies as their pages arrive
+        prefetched = 0
+        for movie in movies_iter:
+            movies.append(movie)
+            yield movie
+            if len(movies) - prefetched >= PREFETCH_CHUNK:
+                details_prefetcher.prefetch((new_movie.json for new_movie in movies[prefetched:]), username)
+                prefetched = len(movies)
+        details_prefetcher.prefetch((new_movie.json for new_movie in movies[prefetched:]), username)
+
+        # Every page is in: hand the watchlist to the requests waiting on this scrape
+        fetch.finish(movies)
+    except Exception as e:
+        # The page is already being sent, so show the movies fetched so far with a notice (the selection step will fetch the watchlist again)
+        print(f"Error fetching the watchlist of {username} after {len(movies)} movies: {e}")
+        status['error'] = f'Letterboxd stopped answering after {len(movies)} movies, so this watchlist is incomplete.'
+        return
+    finally:
+        # Also runs when the browser disconnects, which cancels the pages not fetched yet
+        movies_iter.close()
+        # If the scrape stopped early, the waiting requests fetch the watchlist themselves (does nothing once finished)
+        fetch.fail()
+
+    watchlist_store.put(username, movies, token=token)
+
 @app.route('/', methods=['GET', 'POST'])
+@profiled
 def index():
     movies = None
     random_movie = None
@@ -570,6 +896,12 @@ def index():
     circuit_image = None
     selected_movies = []
     selected_count = 0
+    watchlist_token = None
+    random_movies = []
+    pick_count = 1
+    shuffle_queue = False
+    streaming = False
+    stream_status = None
     
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
@@ -579,65 +911,186 @@ def index():
             error = 'Please enter a username.'
         else:
             try:
-                # Fetch watchlist if not already loaded
-                if not movies:
-                    movies = fetch_watchlist(username)
+                # Reuse the watchlist loaded in the previous step when its snapshot is still stored
+                snapshot = watchlist_store.get(request.form.get('watchlist_token'))
+                if snapshot is not None and snapshot.username == username:
+                    movies = snapshot.movies
+                    watchlist_token = snapshot.token
+
+                # Quick pick: choose any movie of the watchlist, fetching only the pages needed
+                if step == 'quick_pick':
+                    random_movie, quantum_result = fetch_random_movie(username)
+                    if random_movie is None:
+                        error = 'No movies found for this user.'
+                    else:
+                        random_movies = [random_movie]
+                        circuit_image = url_for('get_circuit_image', num_qubits=quantum_result.qc.num_qubits, image_format=CIRCUIT_IMAGE_FORMAT)
+                        quantum_info = {
+                            'random_numbers': [quantum_result.random_number],
+                            'num_qubits': quantum_result.qc.num_qubits
+                        }
+
+                # On the first load, send the page as soon as the first watchlist page arrives and stream the rest of the movies as they come
+                # (unless the watchlist is cached, can be refreshed from an earlier scrape or another request is already scraping it, see below)
+                elif not movies and step != 'select' and STREAM_WATCHLIST and not watchlist_cache.has_previous(username) and (fetch := watchlist_cache.begin_fetch(username)):
+                    try:
+                        movies_iter = fetch_watchlist_iter(username)
+                        first_movie = next(movies_iter, None)
+                    except Exception:
+                        fetch.fail()
+                        raise
+                    if first_movie is None:
+                        fetch.finish([])
+                        error = 'No movies found for this user.'
+                    else:
+                        watchlist_token = watchlist_store.new_token()
+                        stream_status = {}
+                        movies = stream_watchlist(username, watchlist_token, first_movie, movies_iter, fetch, stream_status)
+                        streaming = True
+
+                # Fetch watchlist if not already loaded (from the shared cache, waiting on the scrape already in flight for this user,
+                # or fetching only the pages added since an earlier scrape)
+                elif not movies:
+                    movies = watchlist_cache.get_or_fetch(username, fetch_watchlist, refresh_watchlist)
                     if not movies:
                         error = 'No movies found for this user.'
+                    else:
+                        details_prefetcher.prefetch((movie.json for movie in movies), username)
+                        watchlist_token = watchlist_store.put(username, movies).token
                 
                 # Handle movie selection step
                 if step == 'select' and movies:
                     selected_indices = request.form.getlist('selected_movies')
-                    selected_movies = [int(idx) for idx in selected_indices if idx.isdigit()]
+                    selected_movies = [int(idx) for idx in selected_indices if idx.isdigit() and int(idx) < len(movies)]
                     
                     if selected_movies:
                         # Get the selected movies
                         selected_movie_objects = [movies[i] for i in selected_movies]
                         selected_count = len(selected_movie_objects)
                         
+                        # Number of movies to pick (all of them when shuffling the selection into a queue)
+                        pick_count = int(request.form.get('pick_count', '1')) if request.form.get('pick_count', '1').isdigit() else 1
+                        shuffle_queue = bool(request.form.get('shuffle_queue'))
+                        if shuffle_queue:
+                            pick_count = selected_count
+                        pick_count = max(1, min(pick_count, selected_count))
+
                         # Use quantum random number generator on selected movies
-                        quantum_result = qrng(len(selected_movie_objects) - 1)
-                        random_movie = selected_movie_objects[quantum_result.random_number]
+                        if pick_count == 1:
+                            quantum_result = qrng(len(selected_movie_objects) - 1)
+                            random_numbers = [quantum_result.random_number]
+                        else:
+                            # Draw all the different movies from a single batched simulation
+                            quantum_result = qrng_many(len(selected_movie_objects) - 1, pick_count)
+                            random_numbers = quantum_result.random_numbers
+                        random_movies = [selected_movie_objects[i] for i in random_numbers]
+                        random_movie = random_movies[0]
                         
-                        # Generate quantum circuit visualization
-                        try:
-                            # Create the circuit image using matplotlib
-                            fig, ax = plt.subplots(figsize=(10, 6))
-                            quantum_result.qc.draw('mpl', ax=ax)
-                            plt.tight_layout()
-                            
-                            # Convert plot to base64 string for embedding in HTML
-                            img_buffer = BytesIO()
-                            plt.savefig(img_buffer, format='png', dpi=150, bbox_inches='tight', 
-                                      facecolor='#232526', edgecolor='none')
-                            img_buffer.seek(0)
-                            circuit_image = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
-                            plt.close()
-                            
-                            # Create quantum info object
-                            quantum_info = {
-                                'random_number': quantum_result.random_number,
-                                'num_qubits': quantum_result.qc.num_qubits
-                            }
-                        except Exception as e:
-                            # If circuit visualization fails, continue without it
-                            print(f"Circuit visualization error: {e}")
-                            quantum_info = {
-                                'random_number': quantum_result.random_number,
-                                'num_qubits': quantum_result.qc.num_qubits
-                            }
+                        # The circuit visualization is rendered once per number of qubits and served (cached) from its own URL
+                        circuit_image = url_for('get_circuit_image', num_qubits=quantum_result.qc.num_qubits, image_format=CIRCUIT_IMAGE_FORMAT)
+                        
+                        # Create quantum info object
+                        quantum_info = {
+                            'random_numbers': random_numbers,
+                            'num_qubits': quantum_result.qc.num_qubits
+                        }
                     else:
                         error = 'Please select at least one movie.'
                         
             except Exception as e:
                 error = f'Error fetching watchlist: {e}'
     
-    return render_template_string(HTML_FORM, movies=movies, random_movie=random_movie, 
-                                error=error, quantum_info=quantum_info, 
-                                circuit_image=circuit_image, request=request,
-                                selected_movies=selected_movies, selected_count=selected_count)
+    context = dict(movies=movies, random_movie=random_movie, 
+                   error=error, quantum_info=quantum_info, 
+                   circuit_image=circuit_image, request=request,
+                   selected_movies=selected_movies, selected_count=selected_count,
+                   watchlist_token=watchlist_token, random_movies=random_movies,
+                   pick_count=pick_count, shuffle_queue=shuffle_queue, streaming=streaming, stream_status=stream_status)
+
+    if streaming:
+        response = Response(stream_with_context(stream_template_string(HTML_FORM, **context)))
+        # If the client goes away before the stream starts, stream_watchlist never runs: end the scrape here so the requests waiting on it
+        # do not wait for the whole lease (both do nothing once the stream has ended them)
+        response.call_on_close(movies_iter.close)
+        response.call_on_close(fetch.fail)
+        return response
+
+    return render_template_string(HTML_FORM, **context)
+
+@app.route('/pick_filtered', methods=['POST'])
+def pick_filtered():
+    """AJAX endpoint to pick random movies among those of a loaded watchlist that match some filters"""
+    try:
+        data = request.get_json()
+        snapshot = watchlist_store.get(data.get('watchlist_token'))
+        if snapshot is None:
+            return jsonify({'success': False, 'error': 'Watchlist not loaded (or expired), please load it again'})
+
+        min_runtime = data.get('min_runtime')
+        max_runtime = data.get('max_runtime')
+        index, missing = get_watchlist_index(snapshot)
+        matches = index.filter(
+            director=data.get('director') or None,
+            decade=data.get('decade') or None,
+            runtime=data.get('runtime') or None,
+            min_runtime=int(min_runtime) if min_runtime not in (None, '') else None,
+            max_runtime=int(max_runtime) if max_runtime not in (None, '') else None,
+        )
+        if not matches:
+            if missing:
+                return jsonify({'success': False, 'missing': missing,
+                                'error': f'No movies match the filters yet: the details of {missing} movies are still loading, try again in a moment'})
+            return jsonify({'success': False, 'error': 'No movies match the filters'})
+
+        # Use quantum random number generator on the matching movies
+        pick_count = max(1, min(int(data.get('count') or 1), len(matches)))
+        if pick_count == 1:
+            quantum_result = qrng(len(matches) - 1)
+            random_numbers = [quantum_result.random_number]
+        else:
+            quantum_result = qrng_many(len(matches) - 1, pick_count)
+            random_numbers = quantum_result.random_numbers
+
+        return jsonify({
+            'success': True,
+            'matches': len(matches),
+            'missing': missing,
+            'movies': [{
+                'movie_index': matches[i],
+                'name': snapshot.movies[matches[i]].name,
+                'url': snapshot.movies[matches[i]].url,
+                'poster': snapshot.movies[matches[i]].poster
+            } for i in random_numbers],
+            'num_qubits': quantum_result.qc.num_qubits,
+            'circuit_image': url_for('get_circuit_image', num_qubits=quantum_result.qc.num_qubits, image_format=CIRCUIT_IMAGE_FORMAT)
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/circuit/<int:num_qubits>.<image_format>')
+def get_circuit_image(num_qubits, image_format):
+    """Serve the diagram of the quantum circuit with the given number of qubits"""
+    if image_format not in CIRCUIT_IMAGE_MIMETYPES or not 1 <= num_qubits <= CIRCUIT_IMAGE_MAX_QUBITS:
+        abort(404)
+
+    try:
+        # The first diagram of each format imports matplotlib and its backend, which must not happen on a native thread of the async mode
+        if image_format in circuit_image_formats_drawn:
+            image = run_cpu_bound(render_circuit_image, num_qubits, image_format)
+        else:
+            image = render_circuit_image(num_qubits, image_format)
+            circuit_image_formats_drawn.add(image_format)
+    except Exception as e:
+        print(f"Circuit visualization error: {e}")
+        abort(500)
+
+    # The diagram for a number of qubits never changes, so browsers and proxies can keep it
+    response = Response(image, mimetype=CIRCUIT_IMAGE_MIMETYPES[image_format])
+    response.headers['Cache-Control'] = f'public, max-age={CIRCUIT_IMAGE_MAX_AGE}, immutable'
+    return response
 
 @app.route('/get_movie_details', methods=['POST'])
+@profiled
 def get_movie_details():
     """AJAX endpoint to fetch movie details"""
     try:
@@ -645,19 +1098,131 @@ def get_movie_details():
         movie_index = data.get('movie_index')
         json_endpoint = data.get('json_endpoint')
         
-        if movie_index is not None and json_endpoint:
-            movie_details = fetch_movie_details(json_endpoint)
-            if movie_details:
-                return jsonify({
-                    'success': True,
-                    'director': movie_details.get('directors', [{}])[0].get('name', 'Unknown') if movie_details.get('directors') else 'Unknown',
-                    'year': movie_details.get('releaseYear', 'Unknown'),
-                    'runtime': movie_details.get('runTime', 'Unknown')
-                })
+        if movie_index is not None and is_details_endpoint(json_endpoint):
+            summary = get_movie_summary(json_endpoint)
+            if summary:
+                return jsonify({'success': True, **summary})
         
         return jsonify({'success': False, 'error': 'Invalid request'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/get_movie_details_batch', methods=['POST'])
+@profiled
+def get_movie_details_batch():
+    """AJAX endpoint to fetch the details of several movies at once"""
+    try:
+        data = request.get_json()
+        movies = data.get('movies') or []
+
+        if not isinstance(movies, list) or not movies or len(movies) > DETAILS_BATCH_MAX:
+            return jsonify({'success': False, 'error': 'Invalid request'})
+
+        movies = [movie for movie in movies if isinstance(movie, dict) and movie.get('movie_index') is not None and is_details_endpoint(movie.get('json_endpoint'))]
+
+        summaries = get_movie_summaries(movie['json_endpoint'] for movie in movies)
+
+        results = []
+        for movie in movies:
+            summary = summaries.get(movie['json_endpoint'])
+            if summary:
+                results.append({'movie_index': movie['movie_index'], 'success': True, **summary})
+            else:
+                results.append({'movie_index': movie['movie_index'], 'success': False})
+
+        return jsonify({'success': True, 'results': results})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/metrics')
+def get_metrics():
+    """Timings and counters of this worker process, in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profiles')
+def list_request_profiles():
+    """Slowest profiled requests (when profiling is enabled, see request_profiler.py)"""
+    token = request.args.get('token', '')
+    if not request_profiler.admin_authorized(token):
+        abort(404)
+
+    profiles = request_profiler.list_profiles(int(request.args.get('limit', 20)) if request.args.get('limit', '').isdigit() else 20)
+    for profile in profiles:
+        profile['url'] = url_for('show_request_profile', name=profile['name'], token=token or None)
+    return jsonify({'profiles': profiles})
+
+@app.route('/admin/profiles/<name>')
+def show_request_profile(name):
+    """The functions of a profiled request as text, sorted by cumulative time (?download=1 for the raw cProfile file)"""
+    token = request.args.get('token', '')
+    if not request_profiler.admin_authorized(token):
+        abort(404)
+
+    if request.args.get('download'):
+        path = request_profiler.profile_path(name)
+        if path is None:
+            abort(404)
+        return send_file(path, mimetype='application/octet-stream', as_attachment=True, download_name=name + '.prof')
+
+    sort = request.args.get('sort', 'cumulative')
+    text = request_profiler.format_profile(name, sort=sort if sort in ('cumulative', 'tottime', 'calls') else 'cumulative')
+    if text is None:
+        abort(404)
+    return Response(text, mimetype='text/plain')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.teardown_request
+def record_request_time(error=None):
+    # Runs once the response is sent (after the last chunk for streamed pages)
+    if 'request_started' in g:
+        metrics.observe('randmov_http_request_seconds', time.perf_counter() - g.request_started, endpoint=request.endpoint or 'unknown')
+
+def collect_cache_metrics():
+    """Hits and misses of the in-memory caches, read from the caches themselves, and the movies the details prefetch is working on"""
+    circuit_images = render_circuit_image.cache_info()
+    yield 'randmov_cache_requests_total', {'cache': 'circuit_image', 'result': 'hit'}, circuit_images.hits
+    yield 'randmov_cache_requests_total', {'cache': 'circuit_image', 'result': 'miss'}, circuit_images.misses
+
+    if QRNG_MODE == 'pool':
+        pool_stats = get_entropy_pool().stats()
+        yield 'randmov_cache_requests_total', {'cache': 'entropy_pool', 'result': 'hit'}, pool_stats['hits']
+        yield 'randmov_cache_requests_total', {'cache': 'entropy_pool', 'result': 'miss'}, pool_stats['misses']
+
+    yield 'randmov_details_prefetch_in_flight', {}, details_prefetcher.in_flight()
+
+metrics.register_collector(collect_cache_metrics)
+
+def warmup():
+    """Load and prime Qiskit (transpiler and simulator) and matplotlib, so the first pick does not pay for them"""
+    started = time.perf_counter()
+    qrng(1)
+    startup_report['warmup_qrng'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    render_circuit_image(1, CIRCUIT_IMAGE_FORMAT)
+    startup_report['warmup_circuit_image'] = time.perf_counter() - started
+
+    print(f"Warm-up done in {startup_report['warmup_qrng'] + startup_report['warmup_circuit_image']:.2f}s "
+          f"(qrng {startup_report['warmup_qrng']:.2f}s, circuit diagram {startup_report['warmup_circuit_image']:.2f}s)")
+
+# Seconds spent in each startup phase
+startup_report = {'import': time.perf_counter() - startup_started}
+print(f"RandMov app loaded in {startup_report['import']:.2f}s")
+
+# Optional warm-up: "preload" runs it before serving (in the gunicorn master when started with --preload, so every worker inherits it),
+# "background" runs it in a thread while the app already serves requests
+WARMUP_MODE = os.environ.get('RANDMOV_WARMUP', '')
+if WARMUP_MODE == 'preload':
+    warmup()
+elif WARMUP_MODE == 'background':
+    threading.Thread(target=warmup, name='warmup', daemon=True).start()
+
+# Optionally render the diagrams for 1 to 16 qubits at startup (in the background, as it takes a few seconds)
+if os.environ.get('RANDMOV_PRERENDER_CIRCUITS'):
+    threading.Thread(target=prerender_circuit_images, name='prerender-circuits', daemon=True).start()
+
 if __name__ == '__main__':
     app.run(debug=True) 
\ No newline at end of file
@@ -0,0 +1,43 @@
+import os
+import sys
+import tracemalloc
+
+# Compares the memory used by a watchlist kept as a list of Movie objects and as a CompactWatchlist.
+#
+# Usage: python benchmarks/bench_watchlist_memory.py [number of movies ...]
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from randmov_html_parser import movie_from_attributes
+from compact_watchlist import CompactWatchlist
+
+def make_movies(count):
+    # Movies shaped like the ones parsed from a watchlist page (the strings are built here, like the parser does)
+    movies = []
+    for i in range(count):
+        slug = f'synthetic-film-title-{i}-{1950 + i % 75}'
+        movies.append(movie_from_attributes(f'/film/{slug}/', f'/film/{slug}/json/', f'/film/{slug}/image-150/',
+                                            f'Synthetic Film Title {i} ({1950 + i % 75})'))
+    return movies
+
+def measure(build):
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [500, 3000, 10000]
+
+    for count in counts:
+        movies, list_size = measure(lambda: make_movies(count))
+
+        compact, compact_size = measure(lambda: CompactWatchlist(movies))
+        assert [(m.name, m.poster, m.url, m.json) for m in compact] == [(m.name, m.poster, m.url, m.json) for m in movies]
+
+        print(f'{count:>6} movies: list of Movie {list_size / 1024:8.1f} KiB | CompactWatchlist {compact_size / 1024:8.1f} KiB '
+              f'({list_size / compact_size:.1f}x smaller)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+
+# Checks that every watchlist page parser engine returns exactly the same movies and page count as the BeautifulSoup one
+# on the saved fixture pages, and shows how long each engine takes per page.
+#
+# Usage: python benchmarks/check_parser.py [fixture.html ...]
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from randmov_html_parser import PARSER_ENGINES, parse_watchlist_page
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Engine whose output is taken as the correct one
+REFERENCE_ENGINE = 'soup'
+
+def describe(result):
+    movies, page_count = result
+    if movies is None:
+        return None, page_count
+    return [(movie.name, movie.poster, movie.url, movie.json) for movie in movies], page_count
+
+def time_engine(html, engine, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parse_watchlist_page(html, engine)
+    return (time.perf_counter() - start) / repeat
+
+def main():
+    paths = sys.argv[1:] or sorted(
+        os.path.join(FIXTURES_DIR, name) for name in os.listdir(FIXTURES_DIR) if name.startswith('watchlist_') and name.endswith('.html')
+    )
+
+    failures = 0
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+
+        expected = describe(parse_watchlist_page(html, REFERENCE_ENGINE))
+        timings = []
+        for engine in PARSER_ENGINES:
+            if describe(parse_watchlist_page(html, engine)) != expected:
+                print(f'MISMATCH: {os.path.basename(path)} parsed by "{engine}" differs from "{REFERENCE_ENGINE}"')
+                failures += 1
+            timings.append(f'{engine} {time_engine(html, engine) * 1000:.2f} ms')
+
+        movies, page_count = expected
+        print(f'{os.path.basename(path)}: {len(movies) if movies is not None else "no grid"} movies, {page_count} pages | ' + ', '.join(timings))
+
+    if failures:
+        print(f'\n{failures} mismatch(es) found')
+        sys.exit(1)
+
+    print('\nAll engines agree')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import os
+import sys
+import tempfile
+
+# Checks who may use the request profiler: the X-RandMov-Profile header and the admin routes only answer to RANDMOV_PROFILE_TOKEN,
+# and any other value (including non-ASCII ones, which the client fully controls) is refused without an error.
+#
+# Usage: python benchmarks/check_profiler.py
+
+TOKEN = 's3cret'
+
+# Set before the app is imported, which reads them
+os.environ['RANDMOV_PROFILE'] = '1'
+os.environ['RANDMOV_PROFILE_TOKEN'] = TOKEN
+os.environ.setdefault('RANDMOV_DATA_DIR', tempfile.mkdtemp(prefix='randmov-check-'))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app
+
+# (description, method, path, headers, expected status)
+CASES = [
+    ('page without the header', 'get', '/', {}, 200),
+    ('page with the token in the header', 'get', '/', {'X-RandMov-Profile': TOKEN}, 200),
+    ('page with a wrong header', 'get', '/', {'X-RandMov-Profile': 'nope'}, 200),
+    ('page with a non-ASCII header', 'get', '/', {'X-RandMov-Profile': 'café'.encode().decode('latin-1')}, 200),
+    ('profiles without a token', 'get', '/admin/profiles', {}, 404),
+    ('profiles with a wrong token', 'get', '/admin/profiles?token=nope', {}, 404),
+    ('profiles with a non-ASCII token', 'get', '/admin/profiles?token=%C3%A9', {}, 404),
+    ('profiles with the token', 'get', f'/admin/profiles?token={TOKEN}', {}, 200),
+]
+
+def main():
+    client = app.test_client()
+
+    failures = 0
+    for description, method, path, headers, expected in CASES:
+        status = getattr(client, method)(path, headers=headers).status_code
+        if status != expected:
+            print(f'FAIL: {description}: {status} (expected {expected})')
+            failures += 1
+        else:
+            print(f'ok: {description}: {status}')
+
+    if failures:
+        print(f'\n{failures} check(s) failed')
+        sys.exit(1)
+
+    print('\nAll checks passed')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for Letterboxd, for load tests of the app: serves synthetic watchlist pages (same ul.grid / li.griditem / div.react-component
+# markup and pagination block as Letterboxd) and movie details JSON, with configurable page counts, latency (and slow stragglers), errors and rate limiting.
+#
+# Point the app at it with RANDMOV_LETTERBOXD_URL=http://127.0.0.1:8700 (see benchmarks/load_test.py).
+#
+# Usage: python benchmarks/fake_letterboxd.py [--port 8700] [--pages 5] [--page-size 28] [--latency 50] [--jitter 20]
+#                                               [--error-rate 0.01] [--rate-limit 0.01] [--retry-after 1] [--straggler-rate 0.02] [--straggler-latency 3000]
+#
+# Every username has "--pages" watchlist pages, unless it ends with "-<number>" (e.g. "user-40" has 40 pages, "user-0" an empty watchlist).
+# GET /_stats returns the number of requests served by kind and status.
+
+DIRECTORS = ['Ada Marlowe', 'Kenji Sato', 'Lucia Ferrante', 'Tom Okafor', 'Ingrid Vass', 'Pablo Reyes', 'Mina Park', 'Olu Adeyemi']
+
+def page_count_of(username, default_pages):
+    match = re.search(r'-(\d+)$', username)
+    return int(match.group(1)) if match else default_pages
+
+def film_slug(username, position):
+    return f'{username.lower()}-film-{position}'
+
+def watchlist_page(username, page, pages, page_size):
+    """Html of a watchlist page, shaped like Letterboxd's (None past the last page)"""
+    if page < 1 or page > max(pages, 1):
+        return None
+
+    # The last page holds the remainder (two thirds of a page), the others are full
+    count = 0 if pages == 0 else page_size if page < pages else max(1, page_size * 2 // 3)
+    first = (page - 1) * page_size
+    items = []
+    for position in range(first, first + count):
+        slug = film_slug(username, position)
+        name = escape(f'{slug.replace("-", " ").title()} ({1920 + zlib.crc32(slug.encode()) % 105})')
+        items.append(
+            f'<li class="griditem poster-container"><div class="react-component" data-component-class="LazyPoster" '
+            f'data-item-name="{name}" data-item-slug="{slug}" data-target-link="/film/{slug}/" data-details-endpoint="/film/{slug}/json/" '
+            f'data-poster-url="/film/{slug}/image-150/" data-item-full-display-name="{name}"><div class="poster film-poster">'
+            f'<img src="https://s.ltrbxd.com/static/img/empty-poster-150.png" alt="{name}"></div></div></li>'
+        )
+
+    pagination = ''
+    if pages > 1:
+        shown = sorted({1, 2, page - 1, page, page + 1, pages} & set(range(1, pages + 1)))
+        pagination = '<div class="pagination"><div class="paginate-pages"><ul>' + ''.join(
+            f'<li class="paginate-page paginate-current"><span>{number}</span></li>' if number == page
+            else f'<li class="paginate-page"><a href="/{username}/watchlist/page/{number}/">{number}</a></li>'
+            for number in shown
+        ) + '</ul></div></div>'
+
+    return (
+        f'<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><title>{escape(username)}\'s Watchlist</title></head>'
+        f'<body class="list-page watchlist"><div id="content" class="site-body"><section class="section col-main">'
+        f'<ul class="poster-list -p150 -grid grid film-list">{"".join(items)}</ul>{pagination}</section></div></body></html>'
+    )
+
+def movie_details(slug):
+    """Details JSON of a movie, derived from its slug so it is always the same"""
+    seed = zlib.crc32(slug.encode())
+    return {
+        'name': slug.replace('-', ' ').title(),
+        'slug': slug,
+        'url': f'/film/{slug}/',
+        'releaseYear': 1920 + seed % 105,
+        'runTime': 70 + seed % 110,
+        'directors': [{'name': DIRECTORS[seed % len(DIRECTORS)], 'url': f'/director/{seed % len(DIRECTORS)}/'}],
+    }
+
+class FakeLetterboxdHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    options = None  # argparse options, set by serve()
+    stats = Counter()
+    stats_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        options = self.options
+        if self.path == '/_stats':
+            with self.stats_lock:
+                body = json.dumps(dict(self.stats)).encode()
+            return self.reply(200, body, 'application/json', 'stats')
+
+        page_match = re.match(r'^/([^/]+)/watchlist/page/(\d+)/?$', self.path)
+        details_match = re.match(r'^/film/([^/]+)/json/?$', self.path)
+        kind = 'watchlist' if page_match else 'details' if details_match else 'other'
+
+        delay = options.latency + random.uniform(-options.jitter, options.jitter)
+        if random.random() < options.straggler_rate:
+            delay += options.straggler_latency
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        roll = random.random()
+        if roll < options.rate_limit:
+            return self.reply(429, b'Too Many Requests', 'text/plain', kind, {'Retry-After': str(options.retry_after)})
+        if roll < options.rate_limit + options.error_rate:
+            return self.reply(503, b'Service Unavailable', 'text/plain', kind)
+
+        if page_match:
+            username = page_match.group(1)
+            html = watchlist_page(username, int(page_match.group(2)), page_count_of(username, options.pages), options.page_size)
+            if html is not None:
+                return self.reply(200, html.encode(), 'text/html; charset=utf-8', kind)
+        elif details_match:
+            return self.reply(200, json.dumps(movie_details(details_match.group(1))).encode(), 'application/json', kind)
+
+        self.reply(404, b'Not Found', 'text/plain', kind)
+
+    def reply(self, status, body, content_type, kind, headers=None):
+        with self.stats_lock:
+            self.stats[f'{kind}.{status}'] += 1
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(options):
+    FakeLetterboxdHandler.options = options
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer((options.host, options.port), FakeLetterboxdHandler)
+    server.daemon_threads = True
+    print(f'Fake Letterboxd on http://{options.host}:{options.port} ({options.pages} pages of {options.page_size} films, '
+          f'{options.latency}±{options.jitter} ms, {options.straggler_rate:.1%} stragglers, {options.error_rate:.1%} errors, {options.rate_limit:.1%} rate limited)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for Letterboxd (watchlist pages and movie details)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8700)
+    parser.add_argument('--pages', type=int, default=5, help='watchlist pages per user (usernames ending in "-<number>" set their own)')
+    parser.add_argument('--page-size', type=int, default=28, help='films per full watchlist page')
+    parser.add_argument('--latency', type=float, default=50, help='mean response delay in milliseconds')
+    parser.add_argument('--jitter', type=float, default=20, help='random delay added or removed, in milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests answered with 503')
+    parser.add_argument('--rate-limit', type=float, default=0, help='fraction of requests answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After (seconds) sent with 429 responses')
+    parser.add_argument('--straggler-rate', type=float, default=0, help='fraction of requests answered much later than the others')
+    parser.add_argument('--straggler-latency', type=float, default=3000, help='extra delay of those requests, in milliseconds')
+    serve(parser.parse_args())
+
+if __name__ == '__main__':
+    main()
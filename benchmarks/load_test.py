@@ -0,0 +1,163 @@
+import argparse
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Load test of the running web app: each virtual user loads a watchlist, asks for the details of its movies in batches (like the page does)
+# and picks a random movie from a selection, over and over. Reports the throughput and the p50/p95/p99 latency of each endpoint.
+#
+# Run it against the app pointed at the local Letterboxd stand-in, so no request reaches Letterboxd:
+#   python benchmarks/fake_letterboxd.py --latency 80 &
+#   RANDMOV_LETTERBOXD_URL=http://127.0.0.1:8700 gunicorn -w 4 app:app &
+#   python benchmarks/load_test.py --app http://127.0.0.1:8000 --users 20 --duration 30
+#
+# Usage: python benchmarks/load_test.py [--app URL] [--users N] [--duration S] [--watchlists N] [--pages N] [--details-batches N] [--select N] [--output file.json]
+
+# Movies per /get_movie_details_batch request, as sent by the page
+DETAILS_BATCH_SIZE = 25
+
+MOVIE_CHECKBOX = re.compile(r'name="selected_movies" value="(\d+)" id="movie\d+"\s+data-json-endpoint="([^"]+)"')
+WATCHLIST_TOKEN = re.compile(r'name="watchlist_token" value="([^"]*)"')
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of already sorted values"""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+class LoadStats():
+    '''
+    - Latencies (seconds) and failures recorded per endpoint by every virtual user.
+    - Safe to use from multiple threads.
+    '''
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.failures = defaultdict(int)
+        self.iterations = 0
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, latency, ok):
+        with self._lock:
+            self.latencies[endpoint].append(latency)
+            if not ok:
+                self.failures[endpoint] += 1
+
+    def finish_iteration(self):
+        with self._lock:
+            self.iterations += 1
+
+    def report(self, elapsed):
+        endpoints = {}
+        for endpoint, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            endpoints[endpoint] = {
+                'requests': len(latencies),
+                'failures': self.failures[endpoint],
+                'throughput_rps': len(latencies) / elapsed,
+                'mean_ms': sum(latencies) / len(latencies) * 1000,
+                'p50_ms': percentile(latencies, 0.50) * 1000,
+                'p95_ms': percentile(latencies, 0.95) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+            }
+
+        total = sum(endpoint['requests'] for endpoint in endpoints.values())
+        return {
+            'elapsed_s': elapsed,
+            'iterations': self.iterations,
+            'requests': total,
+            'throughput_rps': total / elapsed,
+            'endpoints': endpoints,
+        }
+
+def timed_post(session, stats, endpoint, url, check, **kwargs):
+    # POST and record the latency of the whole response (streamed pages included); returns the response, or None on errors
+    start = time.perf_counter()
+    try:
+        response = session.post(url, timeout=120, **kwargs)
+        ok = response.status_code == 200 and check(response)
+    except requests.RequestException as e:
+        print(f"Error on {endpoint}: {e}")
+        response, ok = None, False
+
+    stats.record(endpoint, time.perf_counter() - start, ok)
+    return response if ok else None
+
+def run_user(options, stats, stop_at, user_number):
+    """One virtual user: load, details and select, until the end of the test"""
+    session = requests.Session()
+    rng = random.Random(user_number)
+
+    while time.monotonic() < stop_at:
+        username = f'{options.username_prefix}{rng.randrange(options.watchlists)}'
+        if options.pages is not None:
+            username += f'-{options.pages}'
+
+        # Load the watchlist (the page may be streamed, the whole response is timed)
+        response = timed_post(session, stats, 'load', options.app + '/', lambda r: 'watchlist_token' in r.text, data={'username': username})
+        if response is None:
+            continue
+        movies = MOVIE_CHECKBOX.findall(response.text)
+        token_match = WATCHLIST_TOKEN.search(response.text)
+        token = token_match.group(1) if token_match else ''
+
+        # Details of the first movies, in batches like the page asks for them
+        for batch_start in range(0, min(len(movies), options.details_batches * DETAILS_BATCH_SIZE), DETAILS_BATCH_SIZE):
+            batch = [{'movie_index': int(index), 'json_endpoint': endpoint} for index, endpoint in movies[batch_start:batch_start + DETAILS_BATCH_SIZE]]
+            timed_post(session, stats, 'details_batch', options.app + '/get_movie_details_batch',
+                       lambda r: r.json().get('success'), json={'movies': batch})
+
+        # Pick a random movie from a selection
+        if movies:
+            selected = rng.sample([index for index, _ in movies], min(options.select, len(movies)))
+            timed_post(session, stats, 'select', options.app + '/', lambda r: 'movie-title' in r.text,
+                       data={'username': username, 'step': 'select', 'watchlist_token': token, 'selected_movies': selected})
+
+        stats.finish_iteration()
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the RandMov web app')
+    parser.add_argument('--app', default='http://127.0.0.1:5000', help='base URL of the running app')
+    parser.add_argument('--users', type=int, default=10, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='test length in seconds')
+    parser.add_argument('--watchlists', type=int, default=50, help='number of different watchlists the users pick from')
+    parser.add_argument('--username-prefix', default='loadtest')
+    parser.add_argument('--pages', type=int, help='watchlist pages per user (passed to the stand-in through the username)')
+    parser.add_argument('--details-batches', type=int, default=2, help='details batches requested per load')
+    parser.add_argument('--select', type=int, default=5, help='movies selected before picking')
+    parser.add_argument('--output', help='also save the report to this JSON file')
+    options = parser.parse_args()
+    options.app = options.app.rstrip('/')
+
+    stats = LoadStats()
+    started = time.monotonic()
+    stop_at = started + options.duration
+    with ThreadPoolExecutor(max_workers=options.users) as executor:
+        for future in [executor.submit(run_user, options, stats, stop_at, user) for user in range(options.users)]:
+            future.result()
+    report = stats.report(time.monotonic() - started)
+
+    print(f'{report["iterations"]} load/details/select rounds, {report["requests"]} requests in {report["elapsed_s"]:.1f}s '
+          f'({report["throughput_rps"]:.1f} requests/s) with {options.users} users\n')
+    print(f'{"endpoint":<15} {"requests":>8} {"failed":>7} {"req/s":>8} {"mean":>9} {"p50":>9} {"p95":>9} {"p99":>9}')
+    for endpoint, result in report['endpoints'].items():
+        print(f'{endpoint:<15} {result["requests"]:>8} {result["failures"]:>7} {result["throughput_rps"]:>8.1f} '
+              f'{result["mean_ms"]:>7.0f}ms {result["p50_ms"]:>7.0f}ms {result["p95_ms"]:>7.0f}ms {result["p99_ms"]:>7.0f}ms')
+
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            json.dump({'options': vars(options), **report}, f, indent=2)
+        print(f'\nReport saved to {options.output}')
+
+    if any(result['failures'] for result in report['endpoints'].values()):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+# Offline benchmark suite for the hot paths of the app: parsing and fetching watchlist pages, quantum random numbers,
+# circuit diagram rendering and rendering the page template. Letterboxd is replaced by the saved pages and details in benchmarks/fixtures,
+# so no request leaves the machine.
+#
+# Results are saved as JSON (benchmarks/results by default); pass an earlier result file with --baseline to flag regressions.
+#
+# Usage: python benchmarks/run_benchmarks.py [--only parse,fetch,details,qrng,circuit,template] [--repeat N] [--output file.json] [--baseline file.json] [--threshold 0.2]
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+# Keep the caches of the benchmarked app out of the real data directory
+os.environ.setdefault('RANDMOV_DATA_DIR', tempfile.mkdtemp(prefix='randmov-bench-'))
+# The fixtures are served locally, so do not pace the requests like the ones sent to Letterboxd
+os.environ.setdefault('RANDMOV_HTTP_RATE', '0')
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+import letterboxd_http
+from randmov_html_parser import PARSER_ENGINES, Movie, fetch_watchlist, parse_watchlist_page
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# Saved watchlist pages, in watchlist order
+WATCHLIST_PAGES = ['watchlist_page_1.html', 'watchlist_page_2.html', 'watchlist_page_3.html']
+
+# Largest number asked to the QRNG for each circuit width: 2^n - 1 never rejects a draw, 2^n rejects about half of them
+QRNG_NUMBERS = [2 ** bits - 1 for bits in (1, 4, 8, 12, 16)] + [2 ** bits for bits in (4, 8, 12, 16)]
+
+CIRCUIT_WIDTHS = [1, 4, 8, 16]
+TEMPLATE_SIZES = [10, 1000, 10000]
+SUITES = ['parse', 'fetch', 'details', 'qrng', 'circuit', 'template']
+
+def read_fixture(name, mode='r'):
+    with open(os.path.join(FIXTURES_DIR, name), mode, **({} if 'b' in mode else {'encoding': 'utf-8'})) as f:
+        return f.read()
+
+class FixtureAdapter(BaseAdapter):
+    '''
+    - Transport adapter mounted on the shared Letterboxd session: answers watchlist pages and movie details from the fixture files.
+    - Watchlist page N of any user is WATCHLIST_PAGES[N - 1] (404 past the last one), every details endpoint gets movie_details.json.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.pages = [read_fixture(name, 'rb') for name in WATCHLIST_PAGES]
+        self.details = read_fixture('movie_details.json', 'rb')
+
+    def send(self, request, **kwargs):
+        path = urlsplit(request.url).path
+        match = re.match(r'^/[^/]+/watchlist/page/(\d+)/?$', path)
+
+        status, body, content_type = 404, b'', 'text/plain'
+        if match and 1 <= int(match.group(1)) <= len(self.pages):
+            status, body, content_type = 200, self.pages[int(match.group(1)) - 1], 'text/html; charset=utf-8'
+        elif path.endswith('/json/'):
+            status, body, content_type = 200, self.details, 'application/json'
+
+        response = requests.Response()
+        response.status_code = status
+        response._content = body
+        response.headers = CaseInsensitiveDict({'Content-Type': content_type, 'Content-Length': str(len(body))})
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+def measure(func, repeat, warmup=1):
+    """Run "func" (after "warmup" untimed runs) "repeat" times and return the median and fastest times in milliseconds"""
+    for _ in range(warmup):
+        func()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return {'median_ms': statistics.median(timings), 'min_ms': min(timings), 'runs': repeat}
+
+def per_unit(result, units):
+    # The same timings, for a different unit of work (e.g. per page instead of per call)
+    return {'median_ms': result['median_ms'] / units, 'min_ms': result['min_ms'] / units, 'runs': result['runs']}
+
+def fixture_movies(count):
+    # "count" movies shaped like the fixture ones (the fixture watchlist repeated, with distinct URLs)
+    html_pages = [read_fixture(name) for name in WATCHLIST_PAGES]
+    base = [movie for html in html_pages for movie in parse_watchlist_page(html)[0]]
+    movies = []
+    for i in range(count):
+        movie = base[i % len(base)]
+        suffix = f'-{i // len(base)}' if i >= len(base) else ''
+        movies.append(Movie(movie.name, movie.poster, movie.url.rstrip('/') + suffix + '/', movie.json.replace('/json/', f'{suffix}/json/')))
+    return movies
+
+def bench_parse(results, repeat):
+    pages = [read_fixture(name) for name in WATCHLIST_PAGES]
+    films = sum(len(parse_watchlist_page(html)[0]) for html in pages)
+
+    for engine in PARSER_ENGINES:
+        result = measure(lambda: [parse_watchlist_page(html, engine) for html in pages], repeat)
+        results[f'parse.{engine}.per_page'] = per_unit(result, len(pages))
+        results[f'parse.{engine}.per_1000_films'] = per_unit(result, films / 1000)
+
+def bench_fetch(results, repeat):
+    # fetch_watchlist end to end (session, parallel page fetches, parsing), with the fixture pages as Letterboxd
+    films = len(fetch_watchlist('randmov_fixture'))
+    result = measure(lambda: fetch_watchlist('randmov_fixture'), repeat)
+    results['fetch_watchlist.per_page'] = per_unit(result, len(WATCHLIST_PAGES))
+    results['fetch_watchlist.per_1000_films'] = per_unit(result, films / 1000)
+
+def bench_details(results, repeat):
+    import app
+    from details_cache import DetailsCache
+    from details_prefetch import DetailsPrefetcher
+
+    endpoints = [movie.json for movie in fixture_movies(100)]
+
+    def cold():
+        # A new database every run, so every movie goes through the (fixture) details endpoint and into the cache.
+        # The prefetcher is rebuilt with it, as it checks and fills the cache it was given
+        app.details_cache = DetailsCache(path=os.path.join(tempfile.mkdtemp(prefix='randmov-bench-'), 'details_cache.sqlite3'))
+        app.details_prefetcher = DetailsPrefetcher(app.load_movie_summary, app.details_cache)
+        app.get_movie_summaries(endpoints)
+
+    results['details.cold.per_100_films'] = measure(cold, repeat)
+    results['details.cached.per_100_films'] = measure(lambda: app.get_movie_summaries(endpoints), repeat)
+
+def bench_qrng(results, repeat):
+    from qrng import qrng
+
+    for number in QRNG_NUMBERS:
+        quantum_result = qrng(number)
+        results[f'qrng.max_{number}.{quantum_result.qc.num_qubits}_qubits'] = measure(lambda: qrng(number), repeat)
+
+def bench_circuit(results, repeat):
+    import app
+
+    for num_qubits in CIRCUIT_WIDTHS:
+        # Skip the per-width cache of the app, to time the drawing itself
+        results[f'circuit.png.{num_qubits}_qubits'] = measure(lambda: app.render_circuit_image.__wrapped__(num_qubits, 'png'), repeat)
+
+def bench_template(results, repeat):
+    import app
+    from flask import render_template_string
+    from compact_watchlist import CompactWatchlist
+
+    for count in TEMPLATE_SIZES:
+        movies = CompactWatchlist(fixture_movies(count))
+        context = dict(movies=movies, random_movie=None, error=None, quantum_info=None, circuit_image=None,
+                       selected_movies=[], selected_count=0, watchlist_token='benchmark', random_movies=[],
+                       pick_count=1, shuffle_queue=False, streaming=False)
+
+        with app.app.test_request_context('/', method='POST', data={'username': 'randmov_fixture'}):
+            results[f'template.{count}_films'] = measure(lambda: render_template_string(app.HTML_FORM, request=app.request, **context), repeat)
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'fetch': bench_fetch,
+    'details': bench_details,
+    'qrng': bench_qrng,
+    'circuit': bench_circuit,
+    'template': bench_template,
+}
+
+def compare(results, baseline, threshold):
+    """Names of the benchmarks whose median time grew by more than "threshold" (a fraction) since the baseline"""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous and result['median_ms'] > previous['median_ms'] * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the RandMov hot paths')
+    parser.add_argument('--only', default=','.join(SUITES), help=f'comma separated suites to run ({", ".join(SUITES)})')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark (the median is reported)')
+    parser.add_argument('--output', help='result file (default: benchmarks/results/<date>.json)')
+    parser.add_argument('--baseline', help='earlier result file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown flagged as a regression (0.2 = 20%% slower)')
+    args = parser.parse_args()
+
+    suites = [suite.strip() for suite in args.only.split(',') if suite.strip()]
+    unknown = [suite for suite in suites if suite not in BENCHMARKS]
+    if unknown:
+        parser.error(f'unknown suite(s): {", ".join(unknown)}')
+
+    # No request leaves the machine: Letterboxd is answered from the fixtures
+    for read_retries in (True, False):
+        letterboxd_http.get_session(read_retries).mount(letterboxd_http.BASE_URL, FixtureAdapter())
+
+    results = {}
+    for suite in suites:
+        start = time.perf_counter()
+        BENCHMARKS[suite](results, args.repeat)
+        print(f'{suite}: done in {time.perf_counter() - start:.1f}s')
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+
+    print()
+    for name, result in results.items():
+        line = f'{name:<45} {result["median_ms"]:10.3f} ms (min {result["min_ms"]:.3f})'
+        if baseline and name in baseline:
+            line += f' | baseline {baseline[name]["median_ms"]:.3f} ms ({result["median_ms"] / baseline[name]["median_ms"] - 1:+.0%})'
+        print(line)
+
+    output = args.output or os.path.join(RESULTS_DIR, datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'results': results,
+        }, f, indent=2)
+    print(f'\nResults saved to {output}')
+
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} regression(s) over {args.threshold:.0%}: ' + ', '.join(regressions))
+            sys.exit(1)
+        print(f'\nNo regression over {args.threshold:.0%}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+from array import array
+
+# Compact, read-only container for the movies of a watchlist, used to keep loaded watchlists in memory on the server.
+# Instead of one object (and four full URL strings) per movie, it keeps the name and film slug of every movie in one UTF-8 buffer,
+# and derives the URLs from the slug when they are accessed.
+
+BASE_URL = "https://letterboxd.com"
+
+def _derived_urls(slug):
+    # URLs of a movie as built by randmov_html_parser: (poster, url, json)
+    return f'{BASE_URL}/film/{slug}/image-150/', f'{BASE_URL}/film/{slug}/', f'/film/{slug}/json/'
+
+def _slug_of(movie):
+    # The film slug when every URL of the movie follows the usual pattern, None otherwise
+    prefix = BASE_URL + '/film/'
+    if not (movie.url.startswith(prefix) and movie.url.endswith('/')):
+        return None
+
+    slug = movie.url[len(prefix):-1]
+    if not slug or '/' in slug or _derived_urls(slug) != (movie.poster, movie.url, movie.json):
+        return None
+
+    return slug
+
+class MovieRow():
+    '''
+    - Read-only view of one movie of a CompactWatchlist, with the same attributes as randmov_html_parser.Movie (name, poster, url and json).
+    - Uses __slots__ and only holds the container and a position, so creating one is cheap.
+    '''
+    __slots__ = ('_watchlist', '_position')
+
+    def __init__(self, watchlist, position):
+        self._watchlist = watchlist
+        self._position = position
+
+    @property
+    def name(self):
+        return self._watchlist._field(2 * self._position)
+
+    @property
+    def slug(self):
+        return self._watchlist._field(2 * self._position + 1)
+
+    @property
+    def poster(self):
+        return self._watchlist._urls(self._position)[0]
+
+    @property
+    def url(self):
+        return self._watchlist._urls(self._position)[1]
+
+    @property
+    def json(self):
+        return self._watchlist._urls(self._position)[2]
+
+    def __str__(self):
+        return f'{self.name} ({self.url}) \n {self.json}'
+
+class CompactWatchlist():
+    '''
+    - Built from a sequence of movies (randmov_html_parser.Movie or anything with the same attributes), it behaves as a read-only list of MovieRow.
+    - Names and slugs are stored one after the other in a single UTF-8 buffer, with an array of offsets to find each of them.
+    - Movies whose URLs do not follow the usual "/film/<slug>/" pattern keep their own URLs, so every movie reads back exactly as it was given.
+    '''
+    __slots__ = ('_data', '_offsets', '_extra_urls')
+
+    def __init__(self, movies=()):
+        data = bytearray()
+        offsets = array('L', [0])
+        extra_urls = {}
+
+        for position, movie in enumerate(movies):
+            slug = _slug_of(movie)
+            if slug is None:
+                slug = ''
+                extra_urls[position] = (movie.poster, movie.url, movie.json)
+
+            for field in (movie.name, slug):
+                data += field.encode('utf-8')
+                offsets.append(len(data))
+
+        self._data = bytes(data)
+        self._offsets = offsets
+        self._extra_urls = extra_urls
+
+    def _field(self, field_index):
+        return self._data[self._offsets[field_index]:self._offsets[field_index + 1]].decode('utf-8')
+
+    def _urls(self, position):
+        if position in self._extra_urls:
+            return self._extra_urls[position]
+        return _derived_urls(self._field(2 * position + 1))
+
+    def __len__(self):
+        return (len(self._offsets) - 1) // 2
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError('watchlist index out of range')
+
+        return MovieRow(self, position)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield MovieRow(self, position)
@@ -0,0 +1,43 @@
+import os
+
+# Helpers for the async serving mode: running the app on gunicorn's gevent workers (gunicorn -k gevent app:app).
+# gevent turns every blocking socket call into a coroutine switch, so a single worker process can keep hundreds of requests waiting on Letterboxd at once,
+# while the thread pools already used for watchlist pages and movie details keep bounding how many of those requests run at a time.
+# CPU-bound work (circuit simulation and drawing) would block every coroutine of the worker, so it is sent to a pool of real OS threads instead.
+
+# Number of OS threads used for CPU-bound work in the async serving mode
+CPU_WORKERS = int(os.environ.get('RANDMOV_CPU_WORKERS', 4))
+
+def using_gevent():
+    """Whether the process runs on gevent (its sockets have been monkey-patched, as gunicorn's gevent workers do)"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+
+    return monkey.is_module_patched('socket')
+
+def native_lock():
+    """Lock that also works between the native threads of run_cpu_bound (a plain threading.Lock becomes a gevent lock once gevent has patched threading)"""
+    if using_gevent():
+        from gevent import monkey
+        return monkey.get_original('_thread', 'allocate_lock')()
+
+    import threading
+    return threading.Lock()
+
+def run_cpu_bound(func, *args, **kwargs):
+    '''
+    - Runs "func" and returns its result (or raises its exception).
+    - On gevent, it runs on gevent's pool of native threads (at most CPU_WORKERS at a time), so the other requests of the worker keep being served meanwhile.
+    - Otherwise (sync or threaded workers) it just calls "func".
+    '''
+    if not using_gevent():
+        return func(*args, **kwargs)
+
+    import gevent
+    threadpool = gevent.get_hub().threadpool
+    if threadpool.maxsize != CPU_WORKERS:
+        threadpool.maxsize = CPU_WORKERS
+
+    return threadpool.apply(func, args, kwargs)
@@ -0,0 +1,140 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import metrics
+
+# Persistent cache of the movie details shown in the web app (director, year and runtime), keyed by the Letterboxd details endpoint.
+# It is stored in a SQLite database, so it survives restarts and is shared by every gunicorn worker process.
+
+# Directory where the app keeps its data files
+DATA_DIR = os.environ.get('RANDMOV_DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+
+# Seconds a cached entry is considered fresh (movie metadata almost never changes)
+DETAILS_CACHE_TTL = int(os.environ.get('RANDMOV_DETAILS_CACHE_TTL', 30 * 24 * 3600))
+
+# Maximum number of movies kept in the cache (the least recently used ones are dropped first)
+DETAILS_CACHE_MAX_ENTRIES = int(os.environ.get('RANDMOV_DETAILS_CACHE_MAX_ENTRIES', 200000))
+
+# Reading an entry only refreshes its "last used" time when it is older than this, so most reads do not write to the database
+LAST_USED_RESOLUTION = 3600
+
+# Number of writes between two checks of the cache size
+EVICTION_INTERVAL = 500
+
+def connect_database(path):
+    """Open a SQLite database of the app (creating its directory), in WAL mode so several processes can read and write it at the same time"""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    except OSError as e:
+        # Reported like any other database error, so the callers fall back to working without the cache
+        raise sqlite3.OperationalError(f"cannot create {os.path.dirname(path)}: {e}") from e
+    connection = sqlite3.connect(path, timeout=10, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+class DetailsCache():
+    '''
+    - Stores the projected movie details (a small JSON object) under the details endpoint of each movie.
+    - Entries expire "ttl" seconds after they were stored, and at most "max_entries" entries are kept (least recently used first out).
+    - Each thread uses its own SQLite connection; the database runs in WAL mode so several processes can read and write it at the same time.
+    - Database errors are printed and treated as cache misses, so the app keeps working (uncached) if the database is unavailable.
+    '''
+    def __init__(self, path=None, ttl=DETAILS_CACHE_TTL, max_entries=DETAILS_CACHE_MAX_ENTRIES):
+        self.path = path or os.path.join(DATA_DIR, 'details_cache.sqlite3')
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = connect_database(self.path)
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS movie_details (
+                    endpoint TEXT PRIMARY KEY,
+                    details TEXT NOT NULL,
+                    stored_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            ''')
+            connection.execute('CREATE INDEX IF NOT EXISTS movie_details_last_used ON movie_details (last_used)')
+            self._local.connection = connection
+
+        return connection
+
+    def get(self, endpoint):
+        """Return the cached details of a movie (None if missing or expired)"""
+        return self.get_many([endpoint]).get(endpoint)
+
+    def get_many(self, endpoints):
+        """Return a dict with the cached details of every movie that is in the cache and still fresh"""
+        endpoints = list(dict.fromkeys(endpoints))
+        if not endpoints:
+            return {}
+
+        now = time.time()
+        found = {}
+        stale_last_used = []
+        try:
+            connection = self._connect()
+
+            # Stay well below SQLite's limit on the number of query parameters
+            for start in range(0, len(endpoints), 500):
+                chunk = endpoints[start:start + 500]
+                rows = connection.execute(
+                    f'SELECT endpoint, details, stored_at, last_used FROM movie_details WHERE endpoint IN ({",".join("?" * len(chunk))})',
+                    chunk,
+                ).fetchall()
+                for endpoint, details, stored_at, last_used in rows:
+                    if now - stored_at >= self.ttl:
+                        continue
+                    found[endpoint] = json.loads(details)
+                    if now - last_used >= LAST_USED_RESOLUTION:
+                        stale_last_used.append((now, endpoint))
+
+            if stale_last_used:
+                connection.executemany('UPDATE movie_details SET last_used = ? WHERE endpoint = ?', stale_last_used)
+        except sqlite3.Error as e:
+            print(f"Details cache error: {e}")
+
+        metrics.inc('randmov_cache_requests_total', len(found), cache='details', result='hit')
+        metrics.inc('randmov_cache_requests_total', len(endpoints) - len(found), cache='details', result='miss')
+        return found
+
+    def set(self, endpoint, details):
+        """Store the details of a movie"""
+        now = time.time()
+        try:
+            self._connect().execute(
+                'INSERT OR REPLACE INTO movie_details (endpoint, details, stored_at, last_used) VALUES (?, ?, ?, ?)',
+                (endpoint, json.dumps(details), now, now),
+            )
+        except sqlite3.Error as e:
+            print(f"Details cache error: {e}")
+            return
+
+        with self._writes_lock:
+            self._writes += 1
+            check_size = self._writes % EVICTION_INTERVAL == 1
+
+        if check_size:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones until the cache fits in "max_entries" """
+        try:
+            connection = self._connect()
+            connection.execute('DELETE FROM movie_details WHERE stored_at < ?', (time.time() - self.ttl,))
+            (count,) = connection.execute('SELECT COUNT(*) FROM movie_details').fetchone()
+            if count > self.max_entries:
+                connection.execute(
+                    'DELETE FROM movie_details WHERE endpoint IN (SELECT endpoint FROM movie_details ORDER BY last_used LIMIT ?)',
+                    (count - self.max_entries,),
+                )
+        except sqlite3.Error as e:
+            print(f"Details cache error: {e}")
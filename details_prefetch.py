@@ -0,0 +1,155 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import metrics
+from fetch_scheduler import background
+
+# Background prefetch of movie details: as soon as a watchlist is loaded, the details of its movies that are not cached yet are fetched
+# on a small pool of their own, so most of them are ready by the time the browser asks for them.
+# Every fetch of a movie's details (prefetched or asked for by the browser) is single-flight: a request for a movie already being fetched waits
+# for that fetch instead of sending its own.
+# Prefetches are background requests for the Letterboxd scheduler: they only get a share of the request rate and give way to the users' requests,
+# until the browser asks for a movie being prefetched, which promotes its request.
+
+# Set RANDMOV_PREFETCH_DETAILS=0 to only fetch details when the browser asks for them
+PREFETCH_ENABLED = os.environ.get('RANDMOV_PREFETCH_DETAILS', '1') == '1'
+
+# Threads fetching prefetched details, and most movies waiting to be prefetched per process (the others are fetched when the browser asks)
+PREFETCH_WORKERS = int(os.environ.get('RANDMOV_PREFETCH_WORKERS', 4))
+PREFETCH_MAX_PENDING = int(os.environ.get('RANDMOV_PREFETCH_MAX_PENDING', 2000))
+
+# Most movies of a single watchlist waiting to be prefetched, so one large watchlist cannot take the whole queue
+PREFETCH_MAX_PER_WATCHLIST = int(os.environ.get('RANDMOV_PREFETCH_MAX_PER_WATCHLIST', 500))
+
+# Seconds during which the details of a movie that could not be fetched (missing, invalid or throttled) are not prefetched again,
+# and how many such movies are remembered (the oldest are forgotten first)
+FAILED_TTL = int(os.environ.get('RANDMOV_DETAILS_FAILED_TTL', 600))
+FAILED_MAX_ENTRIES = 10000
+
+class DetailsPrefetcher():
+    '''
+    - "load_summary(json_endpoint)" fetches the details of a movie from Letterboxd, stores them in "details_cache" and returns them (None if unavailable).
+    - prefetch(json_endpoints, watchlist) queues the movies that are neither cached nor already being fetched, in the given order
+      (at most "max_per_watchlist" of them per watchlist at a time).
+    - fetch(json_endpoint) returns the details of a movie: it waits for the fetch in flight for it, or fetches them in the calling thread
+      (taking over a queued prefetch that has not started, so the browser never waits behind the rest of the queue).
+    - Movies whose details could not be fetched are not prefetched again for "failed_ttl" seconds; recently_failed() tells which ones they are.
+    '''
+    def __init__(self, load_summary, details_cache, workers=PREFETCH_WORKERS, max_pending=PREFETCH_MAX_PENDING,
+                 max_per_watchlist=PREFETCH_MAX_PER_WATCHLIST, failed_ttl=FAILED_TTL):
+        self.load_summary = load_summary
+        self.details_cache = details_cache
+        self.max_pending = max_pending
+        self.max_per_watchlist = max_per_watchlist
+        self.failed_ttl = failed_ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='details-prefetch')
+        self._in_flight = {}  # json endpoint -> Future of its summary
+        self._by_watchlist = {}  # watchlist -> movies it queued that are still pending
+        self._promoted = {}  # json endpoint -> event promoting its prefetch to a foreground request
+        self._failed = {}  # json endpoint -> time.monotonic() until which it is not prefetched again, oldest first
+        self._lock = threading.RLock()  # Cancelling a future runs its callbacks right away, in the thread holding the lock
+
+    def _forget(self, json_endpoint, future, watchlist=None):
+        with self._lock:
+            if self._in_flight.get(json_endpoint) is future:
+                del self._in_flight[json_endpoint]
+                self._promoted.pop(json_endpoint, None)
+            if watchlist is not None:
+                self._by_watchlist[watchlist] -= 1
+                if not self._by_watchlist[watchlist]:
+                    del self._by_watchlist[watchlist]
+
+    def _load(self, json_endpoint):
+        # Fetch the details, remembering the movies whose details could not be fetched
+        summary = None
+        try:
+            summary = self.load_summary(json_endpoint)
+            return summary
+        finally:
+            with self._lock:
+                self._failed.pop(json_endpoint, None)
+                if summary is None:
+                    self._failed[json_endpoint] = time.monotonic() + self.failed_ttl
+                    if len(self._failed) > FAILED_MAX_ENTRIES:
+                        del self._failed[next(iter(self._failed))]
+
+    def _load_in_background(self, json_endpoint, promoted):
+        with background(promoted):
+            return self._load(json_endpoint)
+
+    def recently_failed(self, json_endpoints):
+        """The movies among these whose details could not be fetched in the last "failed_ttl" seconds"""
+        now = time.monotonic()
+        with self._lock:
+            return {json_endpoint for json_endpoint in json_endpoints if self._failed.get(json_endpoint, 0) > now}
+
+    def prefetch(self, json_endpoints, watchlist=None):
+        """Start prefetching the details of these movies of "watchlist" in the background (the cache is checked there too, so this returns right away)"""
+        if PREFETCH_ENABLED:
+            self._executor.submit(self._queue_missing, list(json_endpoints), watchlist)
+
+    def _queue_missing(self, json_endpoints, watchlist):
+        json_endpoints = list(dict.fromkeys(json_endpoints))
+        cached = self.details_cache.get_many(json_endpoints)
+        failed = self.recently_failed(json_endpoints)
+
+        queued = []
+        dropped = 0
+        with self._lock:
+            for json_endpoint in json_endpoints:
+                if json_endpoint in cached or json_endpoint in failed or json_endpoint in self._in_flight:
+                    continue
+                if len(self._in_flight) >= self.max_pending or (watchlist is not None and self._by_watchlist.get(watchlist, 0) >= self.max_per_watchlist):
+                    dropped += 1
+                    continue
+                promoted = self._promoted[json_endpoint] = threading.Event()
+                future = self._executor.submit(self._load_in_background, json_endpoint, promoted)
+                self._in_flight[json_endpoint] = future
+                if watchlist is not None:
+                    self._by_watchlist[watchlist] = self._by_watchlist.get(watchlist, 0) + 1
+                queued.append((json_endpoint, future))
+
+        # Outside of the lock: a future that is already done runs its callback right away
+        for json_endpoint, future in queued:
+            future.add_done_callback(lambda future, json_endpoint=json_endpoint: self._forget(json_endpoint, future, watchlist))
+
+        metrics.inc('randmov_details_prefetch_total', len(queued), result='queued')
+        metrics.inc('randmov_details_prefetch_total', len(cached), result='cached')
+        metrics.inc('randmov_details_prefetch_total', dropped, result='dropped')
+        metrics.inc('randmov_details_prefetch_total', len(failed), result='failed_recently')
+
+    def fetch(self, json_endpoint):
+        """Details of a movie that is not cached: from the fetch in flight for it, or fetched now (None if unavailable)"""
+        with self._lock:
+            future = self._in_flight.get(json_endpoint)
+            if future is not None and future.cancel():
+                future = None  # Still queued: fetch it here rather than wait for the prefetches ahead of it
+
+            if future is None:
+                future = self._in_flight[json_endpoint] = Future()
+                future.set_running_or_notify_cancel()
+                owner = True
+            else:
+                # Someone waits for this prefetch now: its request goes out as a foreground one
+                promoted = self._promoted.get(json_endpoint)
+                if promoted is not None:
+                    promoted.set()
+                owner = False
+
+        if not owner:
+            metrics.inc('randmov_details_prefetch_total', result='joined')
+            return future.result()
+
+        try:
+            future.set_result(self._load(json_endpoint))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            self._forget(json_endpoint, future)
+        return future.result()
+
+    def in_flight(self):
+        """Number of movies being fetched or waiting to be prefetched"""
+        with self._lock:
+            return len(self._in_flight)
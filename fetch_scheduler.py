@@ -0,0 +1,210 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+import metrics
+
+# Polite scheduling of the requests sent to Letterboxd, shared by every thread of the process (watchlist pages and movie details go through letterboxd_http.get).
+# Per host it combines a token bucket (average rate and burst), a cap on the requests in flight that adapts AIMD-style
+# (halved when Letterboxd throttles us, grown back by one request per round of successes) and a pause that honours Retry-After.
+# Background requests (the details prefetch, see background()) only get a share of the rate and of the cap, and wait while a user's request is waiting.
+
+# Average requests per second sent to a host, and how many can be sent at once after a quiet period (0 disables the rate limit)
+HTTP_RATE = float(os.environ.get('RANDMOV_HTTP_RATE', 20))
+HTTP_BURST = int(os.environ.get('RANDMOV_HTTP_BURST', 40))
+
+# Most requests in flight to a host at the same time; the adaptive cap moves between 1 and this
+HTTP_MAX_CONCURRENCY = int(os.environ.get('RANDMOV_HTTP_MAX_CONCURRENCY', 16))
+
+# Share of the rate and of the concurrency cap that background requests can use at most
+BACKGROUND_SHARE = float(os.environ.get('RANDMOV_HTTP_BACKGROUND_SHARE', 0.25))
+
+# Seconds after which a waiting background request notices it was promoted to a foreground one
+PROMOTION_CHECK = 0.1
+
+# What HostScheduler.acquire() let a request go out as
+FOREGROUND = 'foreground'
+BACKGROUND = 'background'
+
+# The cap is multiplied by this when a request is throttled (429) or the host is overloaded (5xx)
+DECREASE_FACTOR = 0.5
+
+# Seconds waited after a 429 without a Retry-After header, and the longest Retry-After honoured
+DEFAULT_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 60
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (a number of seconds or an HTTP date), None if missing or invalid"""
+    if not value:
+        return None
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+
+    return min(max(seconds, 0), MAX_RETRY_AFTER)
+
+class HostScheduler():
+    '''
+    - Decides when a request to one host may start: acquire() blocks until the host is not paused, a token is available and fewer than
+      "concurrency_limit" requests are in flight; release() reports how the request went.
+    - AIMD: each throttled or overloaded answer multiplies the limit by DECREASE_FACTOR, each success adds 1/limit (so +1 per round of successes).
+    - A throttled answer with Retry-After pauses every request to the host until then.
+    - Background requests also take a token from a second bucket refilled at "background_share" of the rate, use at most that share of the cap,
+      and never start while a foreground request is waiting (unless they are promoted while they wait).
+    '''
+    def __init__(self, rate=HTTP_RATE, burst=HTTP_BURST, max_concurrency=HTTP_MAX_CONCURRENCY, background_share=BACKGROUND_SHARE):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_concurrency = max(1, max_concurrency)
+        self.background_share = min(max(background_share, 0.01), 1.0)
+        self.concurrency_limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.background_in_flight = 0
+        self.throttled = 0
+        self._tokens = float(self.burst)
+        self._background_burst = max(1.0, self.burst * self.background_share)
+        self._background_tokens = self._background_burst
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting = 0  # Foreground requests waiting in acquire()
+        self._condition = threading.Condition()
+
+    def _refill(self, now):
+        elapsed = now - self._refilled_at
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._background_tokens = min(self._background_burst, self._background_tokens + elapsed * self.rate * self.background_share)
+        self._refilled_at = now
+
+    def acquire(self, deadline=None, background=None):
+        '''
+        - Waits until a request to the host may start, and returns whether it went out as a FOREGROUND or BACKGROUND request
+          (None, without waiting, when the host is paused past "deadline", a time.monotonic() value).
+        - "background" is the event of a background request (see background()): until it is set, the request only gets its share of the host
+          and gives way to the others (see the class).
+        '''
+        with self._condition:
+            waiting = False
+            try:
+                while True:
+                    in_background = background is not None and not background.is_set()
+                    if not in_background and not waiting:
+                        waiting = True
+                        self._waiting += 1
+
+                    now = time.monotonic()
+                    if now < self._paused_until:
+                        if deadline is not None and self._paused_until > deadline:
+                            return None
+                        wait = self._paused_until - now
+                    elif self.in_flight >= int(self.concurrency_limit):
+                        wait = None  # Until a request in flight ends
+                    elif in_background and (self._waiting or self.background_in_flight >= max(1, int(self.concurrency_limit * self.background_share))):
+                        wait = None  # Until the foreground requests are on their way, or a background request ends
+                    elif self.rate <= 0:
+                        break
+                    else:
+                        self._refill(now)
+                        if self._tokens >= 1 and (not in_background or self._background_tokens >= 1):
+                            self._tokens -= 1
+                            if in_background:
+                                self._background_tokens -= 1
+                            break
+                        wait = (1 - self._tokens) / self.rate if self._tokens < 1 else (1 - self._background_tokens) / (self.rate * self.background_share)
+
+                    if in_background:
+                        # Nothing notifies a promotion, so check for it every PROMOTION_CHECK seconds
+                        wait = PROMOTION_CHECK if wait is None else min(wait, PROMOTION_CHECK)
+                    self._condition.wait(wait)
+            finally:
+                if waiting:
+                    self._waiting -= 1
+                    # The background requests held back for this one may go now
+                    self._condition.notify_all()
+
+            self.in_flight += 1
+            if in_background:
+                self.background_in_flight += 1
+                return BACKGROUND
+            return FOREGROUND
+
+    def release(self, outcome, retry_after=None, kind=None):
+        '''
+        - Ends a request started with acquire(): "outcome" is "ok", "throttled" (429), "overloaded" (5xx) or "error" (no answer).
+        - "retry_after" (seconds) pauses the host; "kind" is what acquire() returned.
+        '''
+        with self._condition:
+            self.in_flight -= 1
+            if kind == BACKGROUND:
+                self.background_in_flight -= 1
+            if outcome in ('throttled', 'overloaded'):
+                self.concurrency_limit = max(1.0, self.concurrency_limit * DECREASE_FACTOR)
+            elif outcome == 'ok':
+                self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1 / self.concurrency_limit)
+
+            if outcome == 'throttled':
+                self.throttled += 1
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+            self._condition.notify_all()
+
+    def stats(self):
+        """Return the current concurrency cap, requests in flight (all of them and background ones) and throttled answers so far"""
+        with self._condition:
+            return {
+                'concurrency_limit': int(self.concurrency_limit),
+                'in_flight': self.in_flight,
+                'background_in_flight': self.background_in_flight,
+                'throttled': self.throttled,
+            }
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+_context = threading.local()
+
+@contextmanager
+def background(promoted=None):
+    '''
+    - Requests sent by this thread inside the "with" block are background requests (see HostScheduler).
+    - Setting the "promoted" event (e.g. once a user waits for the result) turns the ones that have not gone out yet into foreground requests.
+    '''
+    previous = getattr(_context, 'background', None)
+    _context.background = promoted if promoted is not None else threading.Event()
+    try:
+        yield
+    finally:
+        _context.background = previous
+
+def in_background():
+    """The event of the background block this thread is in (None outside of one)"""
+    return getattr(_context, 'background', None)
+
+def get_host_scheduler(host):
+    """Return the process-wide scheduler of a host, creating it on first use"""
+    scheduler = _schedulers.get(host)
+    if scheduler is None:
+        with _schedulers_lock:
+            scheduler = _schedulers.setdefault(host, HostScheduler())
+    return scheduler
+
+def all_host_schedulers():
+    """Schedulers created so far, by host"""
+    with _schedulers_lock:
+        return dict(_schedulers)
+
+def collect_scheduler_metrics():
+    """Concurrency cap, requests in flight and throttled answers of every host"""
+    for host, scheduler in all_host_schedulers().items():
+        stats = scheduler.stats()
+        yield 'randmov_http_concurrency_limit', {'host': host}, stats['concurrency_limit']
+        yield 'randmov_http_in_flight', {'host': host}, stats['in_flight']
+        yield 'randmov_http_background_in_flight', {'host': host}, stats['background_in_flight']
+        yield 'randmov_http_throttled_total', {'host': host}, stats['throttled']
+
+metrics.register_collector(collect_scheduler_metrics)
@@ -0,0 +1,202 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+import metrics
+import request_latency
+from fetch_scheduler import get_host_scheduler, in_background, parse_retry_after, DEFAULT_RETRY_AFTER
+
+# Shared HTTP layer for every request made to Letterboxd (watchlist pages and movie details)
+
+# Where requests are sent: set RANDMOV_LETTERBOXD_URL to point the app at a stand-in server (e.g. benchmarks/fake_letterboxd.py)
+BASE_URL = os.environ.get('RANDMOV_LETTERBOXD_URL', "https://letterboxd.com").rstrip('/')
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+
+# (connect, read) timeout in seconds used when a call does not set its own
+DEFAULT_TIMEOUT = (5, 10)
+
+# Number of keep-alive connections kept open to Letterboxd. It should be at least the number of threads making requests at the same time
+POOL_SIZE = int(os.environ.get('RANDMOV_HTTP_POOL_SIZE', 16))
+
+# Retry connection errors, connection resets and 5xx responses with exponential backoff (0.5s, 1s, 2s...)
+# 429 responses are left to get(), which pauses every request to the host instead of just this one
+RETRIES = Retry(
+    total=3,
+    connect=3,
+    read=3,
+    status=3,
+    backoff_factor=0.5,
+    status_forcelist=(500, 502, 503, 504),
+    allowed_methods=frozenset(['GET', 'HEAD']),
+    raise_on_status=False,
+    respect_retry_after_header=False,
+)
+
+# Same, without retrying read timeouts: used for the first try of a request whose read timeout was lowered to the recent latencies,
+# so a timeout is seen (and recorded) right away and the request is sent again with the caller's full timeout
+RETRIES_NO_READ = RETRIES.new(read=False)
+
+# Times a request answered with 429 Too Many Requests is sent again (after its Retry-After) before ThrottledError is raised
+THROTTLE_RETRIES = int(os.environ.get('RANDMOV_HTTP_THROTTLE_RETRIES', 3))
+
+# Most seconds a request waits for Retry-After pauses in total: ThrottledError is raised right away when the next one would end later,
+# so a throttled page or details fetch never holds a user request past the worker timeout
+THROTTLE_MAX_WAIT = float(os.environ.get('RANDMOV_HTTP_THROTTLE_MAX_WAIT', 10))
+
+class ThrottledError(requests.RequestException):
+    """Letterboxd kept answering 429 Too Many Requests: the result is missing, not empty, and the request can be tried again later"""
+    def __init__(self, url, retry_after=None):
+        super().__init__(f"Throttled by Letterboxd (429) on {url}")
+        self.url = url
+        self.retry_after = retry_after
+
+# Threads running the requests that may be hedged (the original and its duplicate), so the caller can wait for whichever answers first
+_hedge_executor = ThreadPoolExecutor(max_workers=POOL_SIZE * 2, thread_name_prefix='letterboxd-hedge')
+
+_sessions = {}
+_session_lock = threading.Lock()
+
+def get_session(read_retries=True):
+    """Return the module-level session (or the one that does not retry read timeouts), creating it on first use"""
+    session = _sessions.get(read_retries)
+    if session is None:
+        with _session_lock:
+            session = _sessions.get(read_retries)
+            if session is None:
+                session = requests.Session()
+                session.headers.update(HEADERS)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, pool_block=True,
+                                      max_retries=RETRIES if read_retries else RETRIES_NO_READ)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _sessions[read_retries] = session
+
+    return session
+
+def _send(url, timeout, endpoint, kwargs, background=None, read_retries=True, sent=None):
+    # Send a request through the host's scheduler, sending it again after the Retry-After of 429 responses ("sent" is set once it goes out)
+    scheduler = get_host_scheduler(urlsplit(url).netloc)
+    deadline = time.monotonic() + THROTTLE_MAX_WAIT
+    retry_after = None
+
+    for attempt in range(THROTTLE_RETRIES + 1):
+        kind = scheduler.acquire(deadline, background)
+        if kind is None:
+            raise ThrottledError(url, retry_after)
+        if sent is not None:
+            sent.set()
+        started = time.perf_counter()
+        try:
+            response = get_session(read_retries).get(url, timeout=timeout, **kwargs)
+        except Exception:
+            scheduler.release('error', kind=kind)
+            raise
+
+        if response.status_code < 500 and response.status_code != 429:
+            scheduler.release('ok', kind=kind)
+            if endpoint is not None:
+                request_latency.record(endpoint, time.perf_counter() - started)
+            return response
+        if response.status_code >= 500:
+            # Still failing after the retries: slow down, and wait for the Retry-After of a 503 if it sent one
+            scheduler.release('overloaded', parse_retry_after(response.headers.get('Retry-After')), kind)
+            return response
+
+        # Throttled: every request to the host waits for the Retry-After (or a growing, jittered delay without one)
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        if retry_after is None:
+            retry_after = DEFAULT_RETRY_AFTER * 2 ** attempt * random.uniform(0.5, 1.5)
+        scheduler.release('throttled', retry_after, kind)
+        response.close()
+
+    raise ThrottledError(url, retry_after)
+
+def _send_timed(url, timeout, endpoint, kwargs, background=None, sent=None):
+    # Send a request of a known endpoint with its read timeout lowered to the recent latencies. A lowered timeout that expires counts as a latency
+    # of that many seconds (so the timeout grows back when Letterboxd slows down), and the request is sent once more with the caller's timeout
+    lowered = request_latency.adaptive_timeout(endpoint, timeout)
+    if lowered == timeout:
+        return _send(url, timeout, endpoint, kwargs, background, sent=sent)
+
+    try:
+        return _send(url, lowered, endpoint, kwargs, background, read_retries=False, sent=sent)
+    except (requests.ReadTimeout, requests.ConnectionError) as e:
+        # A body that stops arriving is reported as a ConnectionError
+        if not isinstance(e, requests.ReadTimeout) and not (e.args and isinstance(e.args[0], ReadTimeoutError)):
+            raise
+        request_latency.record(endpoint, lowered[1] if isinstance(lowered, tuple) else lowered)
+    return _send(url, timeout, endpoint, kwargs, background)
+
+def _discard(future):
+    # Close the response of a hedged request that lost the race, once it arrives
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+def _send_hedged(url, timeout, endpoint, hedge_after, kwargs, background):
+    # Send the request, and a duplicate if it has not been answered "hedge_after" seconds after it went out (budget permitting): the first answer wins
+    sent = threading.Event()
+    original = _hedge_executor.submit(_send_timed, url, timeout, endpoint, kwargs, background, sent)
+    original.add_done_callback(lambda future: sent.set())
+
+    # The time spent waiting for a thread or for the scheduler does not count
+    sent.wait()
+    done, _ = wait([original], timeout=hedge_after)
+    if done or not request_latency.hedge_budget.try_spend():
+        return original.result()
+
+    hedge = _hedge_executor.submit(_send_timed, url, timeout, endpoint, kwargs, background)
+
+    # An error only wins when the other request failed too
+    winner = None
+    pending = {original, hedge}
+    while winner is None:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        winner = next((future for future in done if future.exception() is None), None)
+        if winner is None and not pending:
+            winner = original
+
+    # Nothing can interrupt the request still running: its answer is dropped (a hedge not started yet is cancelled)
+    for future in (original, hedge):
+        if future is not winner and not future.cancel():
+            future.add_done_callback(_discard)
+
+    metrics.inc('randmov_http_hedged_requests_total', endpoint=endpoint, winner='hedge' if winner is hedge else 'original')
+    return winner.result()
+
+def get(path, timeout=DEFAULT_TIMEOUT, endpoint=None, **kwargs):
+    '''
+    - Makes a GET request to Letterboxd through the shared, pooled session.
+    - "path" is a path on Letterboxd (e.g. "/username/watchlist/page/1"); it is always sent to BASE_URL, since some paths come from the browser.
+    - Connection errors and 5xx responses are retried with backoff before the last response (or error) is returned to the caller.
+    - Every request waits for its turn in the host's scheduler (rate limit and adaptive concurrency cap, see fetch_scheduler.py), as a background
+      request inside fetch_scheduler.background().
+    - 429 responses pause the host for their Retry-After and are sent again; ThrottledError is raised when they keep coming.
+    - When "endpoint" names the kind of request (e.g. "movie_details"), its latency is recorded, the read timeout follows the recent latencies
+      of that endpoint (a request timing out is sent once more with "timeout"), and the request may be hedged (see request_latency.py).
+    '''
+    if not path.startswith('/'):
+        raise ValueError(f"Not a Letterboxd path: {path!r}")
+
+    url = BASE_URL + path
+    background = in_background()
+    if endpoint is None:
+        return _send(url, timeout, endpoint, kwargs, background)
+
+    # Background requests are never hedged: nobody is waiting on them
+    if background is not None:
+        return _send_timed(url, timeout, endpoint, kwargs, background)
+
+    request_latency.hedge_budget.deposit()
+    hedge_after = request_latency.hedge_delay(endpoint)
+    if hedge_after is None:
+        return _send_timed(url, timeout, endpoint, kwargs)
+    return _send_hedged(url, timeout, endpoint, hedge_after, kwargs, background)
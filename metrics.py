@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Lightweight in-process metrics: counters and fixed-bucket histograms (so memory stays bounded however many values are observed),
+# served in the Prometheus text format by the app's /metrics endpoint. Each process (gunicorn worker) keeps and reports its own values.
+
+# Set RANDMOV_METRICS=0 to turn every metric call into a no-op
+METRICS_ENABLED = os.environ.get('RANDMOV_METRICS', '1') == '1'
+
+# Upper bounds (seconds) of the histogram buckets, from a fast page parse to a slow full scrape
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Type and description of every metric, shown on /metrics
+METRICS = {
+    'randmov_http_request_seconds': ('histogram', 'Time spent serving app requests, by endpoint'),
+    'randmov_watchlist_page_fetch_seconds': ('histogram', 'Time spent downloading a watchlist page from Letterboxd'),
+    'randmov_watchlist_page_parse_seconds': ('histogram', 'Time spent parsing a watchlist page, by parser engine'),
+    'randmov_movie_details_fetch_seconds': ('histogram', 'Time spent downloading the details of a movie from Letterboxd'),
+    'randmov_movie_details_fetches_total': ('counter', 'Movie details downloads, by result'),
+    'randmov_qrng_seconds': ('histogram', 'Time spent generating a quantum random number (or a batch of them), by mode'),
+    'randmov_qrng_circuit_build_seconds': ('histogram', 'Time spent building a circuit, by width'),
+    'randmov_qrng_circuit_transpile_seconds': ('histogram', 'Time spent transpiling a circuit, by width'),
+    'randmov_qrng_circuit_run_seconds': ('histogram', 'Time spent simulating a circuit'),
+    'randmov_qrng_draws_total': ('counter', 'Values drawn from circuit outputs, by result (rejected values are out of range and drawn again)'),
+    'randmov_circuit_image_render_seconds': ('histogram', 'Time spent drawing a circuit diagram, by format'),
+    'randmov_cache_requests_total': ('counter', 'Cache lookups, by cache and result'),
+    'randmov_details_prefetch_total': ('counter', 'Movies handed to the details prefetch, by result (queued, already cached, dropped over the limit, or joined by a browser request)'),
+    'randmov_details_prefetch_in_flight': ('gauge', 'Movies whose details are being fetched or waiting to be prefetched'),
+    'randmov_http_throttled_total': ('counter', 'Requests Letterboxd answered with 429 Too Many Requests, by host'),
+    'randmov_http_concurrency_limit': ('gauge', 'Current adaptive cap on the requests in flight, by host'),
+    'randmov_http_in_flight': ('gauge', 'Requests in flight, by host'),
+    'randmov_http_background_in_flight': ('gauge', 'Background requests (details prefetch) in flight, by host'),
+    'randmov_http_upstream_seconds': ('histogram', 'Time Letterboxd took to answer a request, by endpoint'),
+    'randmov_http_adaptive_timeout_seconds': ('gauge', 'Read timeout derived from the recent latencies (before the cap set by the caller), by endpoint'),
+    'randmov_http_latency_p95_seconds': ('gauge', 'Recent p95 latency of Letterboxd requests (the hedging threshold), by endpoint'),
+    'randmov_http_hedged_requests_total': ('counter', 'Requests duplicated because they were slower than the recent p95, by endpoint and which copy answered first'),
+}
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+class Histogram():
+    '''
+    - Counts observed values in fixed buckets, and keeps their count and sum.
+    - Takes the same memory whatever the number of observations.
+    '''
+    __slots__ = ('buckets', 'bucket_counts', 'count', 'sum')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)  # The last one is the +Inf bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+class MetricsRegistry():
+    '''
+    - Holds the counters and histograms of the process, keyed by metric name and labels.
+    - Collectors registered with register_collector add values read at scrape time (e.g. the hits of an in-memory cache).
+    - Safe to use from multiple threads.
+    '''
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def register_collector(self, collector):
+        """Add a function called on every scrape, returning (metric name, labels dict, value) counters or gauges to report"""
+        self._collectors.append(collector)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (histogram.buckets, list(histogram.bucket_counts), histogram.count, histogram.sum)
+                          for key, histogram in self._histograms.items()}
+
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    counters[(name, tuple(sorted(labels.items())))] = value
+            except Exception as e:
+                print(f"Metrics collector error: {e}")
+
+        families = {}
+        for (name, labels), value in sorted(counters.items()):
+            families.setdefault(name, []).append(f'{name}{_label_text(labels)} {value}')
+
+        for (name, labels), (buckets, bucket_counts, count, total) in sorted(histograms.items()):
+            lines = families.setdefault(name, [])
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ['+Inf'], bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_label_text(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{_label_text(labels)} {total}')
+            lines.append(f'{name}_count{_label_text(labels)} {count}')
+
+        output = []
+        for name in sorted(families):
+            kind, description = METRICS.get(name, ('untyped', ''))
+            output.append(f'# HELP {name} {description}')
+            output.append(f'# TYPE {name} {kind}')
+            output.extend(families[name])
+
+        return '\n'.join(output) + '\n'
+
+registry = MetricsRegistry()
+
+def inc(name, amount=1, **labels):
+    """Add "amount" to a counter"""
+    if METRICS_ENABLED:
+        registry.inc(name, amount, **labels)
+
+def observe(name, value, **labels):
+    """Record a value (usually a duration in seconds) in a histogram"""
+    if METRICS_ENABLED:
+        registry.observe(name, value, **labels)
+
+@contextmanager
+def timer(name, **labels):
+    """Record the time spent in the "with" block in a histogram (also when the block raises)"""
+    if not METRICS_ENABLED:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(name, time.perf_counter() - start, **labels)
+
+def register_collector(collector):
+    """Add a function called on every scrape, returning (metric name, labels dict, value) counters or gauges to report"""
+    registry.register_collector(collector)
+
+def render():
+    """Return every metric in the Prometheus text exposition format"""
+    return registry.render()
@@ -1,5 +1,11 @@
-from qiskit import QuantumCircuit, transpile
-from qiskit_aer import AerSimulator
+import os
+import threading
+import time
+from functools import lru_cache
+import metrics
+from concurrency import run_cpu_bound, native_lock
+
+# Qiskit takes a while to import, so it is only imported when the first circuit is built or simulated
 
 class QuantumRandomNumber():
     def __init__(self, random_number, qc):
@@ -10,18 +16,53 @@ class QuantumRandomNumber():
     def __str__(self):
         return f'Quantum circuit:\n{self.qc.draw('text')}\nGenerated the random number: {self.random_number}'
 
-def qrng(number):
+class QuantumRandomSample():
+    def __init__(self, random_numbers, qc):
+        self.random_numbers = random_numbers
+        self.qc = qc
+
+    def __str__(self):
+        return f'Quantum circuit:\n{self.qc.draw("text")}\nGenerated the random numbers: {self.random_numbers}'
+
+# Number of shots per simulator run. At least half of the values a circuit can output are in range, so one run almost always yields a usable value
+QRNG_SHOTS = 16
+
+# "simulate" runs the circuit for every number, "pool" takes the bits from the background-refilled entropy pool
+QRNG_MODE = os.environ.get('RANDMOV_QRNG_MODE', 'simulate')
+
+# Entropy pool settings: refill below the low watermark up to the high watermark (in bits), with runs of a wide multi-shot circuit
+POOL_LOW_WATERMARK = 16384
+POOL_HIGH_WATERMARK = 65536
+POOL_CIRCUIT_WIDTH = 16
+POOL_SHOTS = 1024
+
+# Seconds a draw waits for the refill when the pool is drained, before simulating the bits itself
+POOL_WAIT_TIMEOUT = 2
+
+_simulator = None
+_simulator_lock = native_lock()
+
+def get_simulator():
+    """Return the long-lived AerSimulator instance shared by every call"""
+    global _simulator
+
+    if _simulator is None:
+        with _simulator_lock:
+            if _simulator is None:
+                from qiskit_aer import AerSimulator
+                _simulator = AerSimulator()
+
+    return _simulator
+
+@lru_cache(maxsize=None)
+def get_circuit(num_of_bits):
     '''
-    - This function generates a random number by simulating the execution of a quantum circuit. 
-    - The parameter "number" sets the upper limit of the number generated.
-    - This function generates the random number using AerSimulator, a high performance simulator for quantum circuits that includes realistic noise models.
-    - Per the Qiskit documentation: "Note that this local simulator is only possible for a small circuit. When you scale up, you will need to use a real device".
+    - Returns the circuit with "num_of_bits" qubits and its transpiled version, built once per width and reused afterwards.
+    - The returned circuits are shared, so they must not be modified.
     '''
-    while True:
-        # Convert to binary and check how many bits in contains (which will be the number of qubits required in the ciruit)
-        number_binary = bin(number)
-        num_of_bits = len(number_binary[2:])
-        
+    from qiskit import QuantumCircuit, transpile
+
+    with metrics.timer('randmov_qrng_circuit_build_seconds', qubits=num_of_bits):
         # Create a circuit with as many qubits as bits in the binary number
         qc = QuantumCircuit(num_of_bits)
 
@@ -31,21 +72,245 @@ def qrng(number):
 
         qc.measure_all()
 
-        qc_transpiled = transpile(qc) # Use 'transpile' to optimize the circuit
-        
-        # Execute the circuit with AerSimulator
-        sim = AerSimulator()
-        result = sim.run(qc_transpiled, shots=1).result()
-        random_number_binary = list(result.get_counts())[0]
-
-        # Convert random number to decimal
-        random_number = int(random_number_binary, 2)
-
-        # Check if the generated number is greater than the desired upper threshold.
-        # This is done because a quantum circuit with 'n' qubits can output a number with all 1s in each position, which might be a larger number than the desired upper threshold.
-        # If that is the case, re-run the qrng until we obtain a result within the desired threshold.
-        if random_number <= number:
-            random_number_instance = QuantumRandomNumber(random_number, qc)
-            break
-        
-    return random_number_instance
\ No newline at end of file
+    with metrics.timer('randmov_qrng_circuit_transpile_seconds', qubits=num_of_bits):
+        qc_transpiled = transpile(qc, get_simulator()) # Use 'transpile' to optimize the circuit for the simulator
+
+    return qc, qc_transpiled
+
+def run_circuit(qc_transpiled, shots):
+    """Simulate a transpiled circuit and return the measured bitstring of every shot, in order"""
+    with metrics.timer('randmov_qrng_circuit_run_seconds'):
+        # The job runs in the calling thread: AerSimulator.run() would hand it to Aer's own thread pool, whose threads are greenlets once gevent
+        # has patched threading (so the simulation would block the hub after all, and could not be waited on from the native threads of run_cpu_bound)
+        return get_simulator()._execute_circuits_job([qc_transpiled], None, {'shots': shots, 'memory': True}).get_memory()
+
+def qrng(number):
+    '''
+    - This function generates a random number by simulating the execution of a quantum circuit. 
+    - The parameter "number" sets the upper limit of the number generated.
+    - This function generates the random number using AerSimulator, a high performance simulator for quantum circuits that includes realistic noise models.
+    - Per the Qiskit documentation: "Note that this local simulator is only possible for a small circuit. When you scale up, you will need to use a real device".
+    - When QRNG_MODE is "pool", the random bits are taken from the background-refilled entropy pool instead of simulating the circuit on demand.
+    - On gevent, the simulated draw runs on a native thread (see concurrency.run_cpu_bound), so the other requests of the worker keep being served.
+    '''
+    with metrics.timer('randmov_qrng_seconds', mode=QRNG_MODE, kind='single'):
+        if QRNG_MODE == 'pool':
+            return get_entropy_pool().qrng(number)
+
+        return run_cpu_bound(_qrng_simulate, number)
+
+def _qrng_simulate(number):
+    # Convert to binary and check how many bits in contains (which will be the number of qubits required in the ciruit)
+    number_binary = bin(number)
+    num_of_bits = len(number_binary[2:])
+
+    qc, qc_transpiled = get_circuit(num_of_bits)
+
+    rejected = 0
+    while True:
+        # Execute the circuit with AerSimulator, keeping the result of every shot in order
+        for random_number_binary in run_circuit(qc_transpiled, QRNG_SHOTS):
+            # Convert random number to decimal
+            random_number = int(random_number_binary, 2)
+
+            # Check if the generated number is greater than the desired upper threshold.
+            # This is done because a quantum circuit with 'n' qubits can output a number with all 1s in each position, which might be a larger number than the desired upper threshold.
+            # If that is the case, use the next shot (or re-run the circuit once all shots are used) until we obtain a result within the desired threshold.
+            if random_number <= number:
+                _count_draws(rejected, 1)
+                return QuantumRandomNumber(random_number, qc)
+            rejected += 1
+
+def _count_draws(rejected, accepted):
+    # Rejection sampling statistics: values out of range are rejected and drawn again
+    if rejected:
+        metrics.inc('randmov_qrng_draws_total', rejected, result='rejected')
+    metrics.inc('randmov_qrng_draws_total', accepted, result='accepted')
+
+def qrng_many(number, k, replace=False):
+    '''
+    - Generates "k" random numbers between 0 and "number" from a single batched simulation of the same circuit used by qrng.
+    - With replace=False the numbers are all different (a random ordering of k of the values), which requires k <= number + 1.
+    - Every shot of the batch provides random bits; each number takes as many bits as its range needs and is rejected if it falls out of range, so all results are equally likely.
+    - More shots are simulated only in the rare case that the first batch runs out of bits.
+    '''
+    if k < 0 or (not replace and k > number + 1):
+        raise ValueError(f'Cannot draw {k} different numbers between 0 and {number}')
+
+    with metrics.timer('randmov_qrng_seconds', mode=QRNG_MODE, kind='batch'):
+        # Draws from the pool stay on the calling greenlet, since they wait on the pool's lock; simulated ones run on a native thread on gevent
+        if QRNG_MODE == 'pool':
+            return _qrng_many(number, k, replace)
+        return run_cpu_bound(_qrng_many, number, k, replace)
+
+def _qrng_many(number, k, replace):
+    num_of_bits = len(bin(number)[2:])
+    qc, qc_transpiled = get_circuit(num_of_bits)
+
+    if QRNG_MODE == 'pool':
+        bits = _BitStream(get_entropy_pool().take_bits)
+    else:
+        # Each draw is accepted with probability above 1/2, so twice as many shots as numbers (plus some margin) is almost always enough
+        shots = 2 * k + QRNG_SHOTS
+
+        def simulate_bits(count):
+            return ''.join(run_circuit(qc_transpiled, max(shots, count // num_of_bits + 1)))
+
+        bits = _BitStream(simulate_bits)
+
+    if replace:
+        random_numbers = [bits.draw(number) for _ in range(k)]
+    else:
+        # Partial Fisher-Yates shuffle of 0..number, storing only the swapped positions
+        swapped = {}
+        random_numbers = []
+        for i in range(k):
+            j = i + bits.draw(number - i)
+            random_numbers.append(swapped.get(j, j))
+            swapped[j] = swapped.get(i, i)
+
+    _count_draws(bits.rejected, k)
+    return QuantumRandomSample(random_numbers, qc)
+
+class _BitStream():
+    # Hands out random bits from a source function, asking it for more whenever they run out
+    def __init__(self, source, chunk_size=POOL_CIRCUIT_WIDTH * 64):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.rejected = 0
+        self._bits = ''
+
+    def take(self, count):
+        while len(self._bits) < count:
+            self._bits += self.source(max(count, self.chunk_size))
+        bits, self._bits = self._bits[:count], self._bits[count:]
+        return bits
+
+    def draw(self, number):
+        # Rejection sampling: take as many bits as "number" has, and retry while the value is out of range
+        num_of_bits = len(bin(number)[2:])
+        while True:
+            random_number = int(self.take(num_of_bits), 2)
+            if random_number <= number:
+                return random_number
+            self.rejected += 1
+
+class EntropyPool():
+    '''
+    - Keeps a bounded pool of random bits generated by simulating a wide quantum circuit (one Hadamard gate and measurement per qubit) with many shots.
+    - A background thread refills the pool whenever it drops below "low_watermark" bits, until it holds "high_watermark" bits.
+    - When the pool does not have enough bits, the caller waits for the refill (up to "wait_timeout" seconds) and then falls back to simulating the bits itself.
+    - Values are drawn by rejection sampling on the bits (like the on-demand qrng), so every number in the range is equally likely.
+    '''
+    def __init__(self, low_watermark=POOL_LOW_WATERMARK, high_watermark=POOL_HIGH_WATERMARK,
+                 circuit_width=POOL_CIRCUIT_WIDTH, shots=POOL_SHOTS, wait_timeout=POOL_WAIT_TIMEOUT):
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.circuit_width = circuit_width
+        self.shots = shots
+        self.wait_timeout = wait_timeout
+        self.hits = 0        # Draws served straight from the pool
+        self.misses = 0      # Draws that had to wait for the refill or simulate on their own
+        self.refills = 0     # Simulator runs made to generate bits
+        self._bits = ''
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """Start the background refill thread (again, if it is not running, e.g. in a process forked after it was started)"""
+        with self._condition:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._refill_loop, name='qrng-entropy-pool', daemon=True)
+                self._thread.start()
+
+        return self
+
+    def _generate_bits(self):
+        # Every qubit of every shot is one random bit
+        _, qc_transpiled = get_circuit(self.circuit_width)
+        return ''.join(run_circuit(qc_transpiled, self.shots))
+
+    def _refill_loop(self):
+        while True:
+            with self._condition:
+                while len(self._bits) >= self.low_watermark:
+                    self._condition.wait()
+
+            # Simulate outside the lock (on a native thread on gevent, where this thread is a greenlet), so draws can keep taking the bits that are left
+            while True:
+                try:
+                    bits = run_cpu_bound(self._generate_bits)
+                except Exception as e:
+                    print(f"Entropy pool refill error: {e}")
+                    time.sleep(1)
+                    break
+
+                with self._condition:
+                    self.refills += 1
+                    self._bits = (self._bits + bits)[:self.high_watermark]
+                    self._condition.notify_all()
+                    if len(self._bits) >= self.high_watermark:
+                        break
+
+    def take_bits(self, count):
+        """Remove "count" random bits from the pool and return them as a string of 0s and 1s"""
+        with self._condition:
+            if len(self._bits) >= count:
+                self.hits += 1
+            else:
+                # Pool drained: wake up the refill thread and wait for it
+                self.misses += 1
+                self._condition.notify_all()
+                self._condition.wait_for(lambda: len(self._bits) >= count, timeout=self.wait_timeout)
+
+            if len(self._bits) >= count:
+                bits, self._bits = self._bits[:count], self._bits[count:]
+                if len(self._bits) < self.low_watermark:
+                    self._condition.notify_all()
+                return bits
+
+        # The refill did not arrive in time, so simulate the bits directly
+        bits = ''
+        while len(bits) < count:
+            bits += run_cpu_bound(self._generate_bits)
+        with self._condition:
+            self.refills += 1
+        return bits[:count]
+
+    def qrng(self, number):
+        """Same as qrng(number), using bits from the pool"""
+        num_of_bits = len(bin(number)[2:])
+
+        # The circuit shown to the user is the one with as many qubits as bits in the number, like in the on-demand qrng
+        qc, _ = get_circuit(num_of_bits)
+
+        rejected = 0
+        while True:
+            random_number = int(self.take_bits(num_of_bits), 2)
+            if random_number <= number:
+                _count_draws(rejected, 1)
+                return QuantumRandomNumber(random_number, qc)
+            rejected += 1
+
+    def stats(self):
+        """Return the pool counters (hits, misses, refills and bits available)"""
+        with self._condition:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'refills': self.refills,
+                'available_bits': len(self._bits),
+            }
+
+_entropy_pool = None
+
+def get_entropy_pool():
+    """Return the process-wide entropy pool, starting its refill thread on first use"""
+    global _entropy_pool
+
+    if _entropy_pool is None:
+        with _simulator_lock:
+            if _entropy_pool is None:
+                _entropy_pool = EntropyPool()
+
+    return _entropy_pool.start()
@@ -1,10 +1,16 @@
-import requests
+import os
+import letterboxd_http
+import metrics
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
 from spinner import spinner
 import threading
-from qrng import qrng
+from qrng import qrng, qrng_many
 
 class Movie:
+    __slots__ = ('name', 'poster', 'url', 'json')
+
     def __init__(self, name, poster, url, json):
         self.name = name
         self.poster = poster
@@ -14,113 +20,494 @@ class Movie:
     def __str__(self):
         return f'{self.name} ({self.url}) \n {self.json}'
 
-# Retrieves the username's watchlist
-def fetch_watchlist(username):
+# Number of watchlist pages fetched in parallel (1 disables concurrent fetching)
+WATCHLIST_WORKERS = int(os.environ.get('RANDMOV_WATCHLIST_WORKERS', 8))
 
-    movies = []
+# Retrieves the html of a single watchlist page (None if the page does not exist)
+# Raises when Letterboxd throttles us (letterboxd_http.ThrottledError) or keeps failing, so a watchlist is never cut short at that page
+def fetch_watchlist_page(username, watchlist_page):
 
-    # To manage multiple-page watchlists
-    watchlist_page = 1
+    # Make http request through the shared Letterboxd session
+    with metrics.timer('randmov_watchlist_page_fetch_seconds'):
+        response = letterboxd_http.get(f"/{username}/watchlist/page/{watchlist_page}", timeout=(5, 10), endpoint='watchlist_page')
 
-    while True:
+    # Letterboxd is still failing after the retries: the page may well exist
+    if response.status_code >= 500:
+        response.raise_for_status()
+
+    # The page does not exist (end of the watchlist pages)
+    if response.status_code != 200:
+        return None
 
-        # Set http request details
-        url = f"https://letterboxd.com/{username}/watchlist/page/{watchlist_page}"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        }
+    return response.text
 
-        # Make http request
-        response = requests.get(url, headers=headers, timeout=(5, 10))
+# Engine used to parse watchlist pages: "stream" (fast, only reads the tags we need) or "soup" (full BeautifulSoup tree)
+PARSER_ENGINE = os.environ.get('RANDMOV_PARSER_ENGINE', 'stream')
+
+# Builds a movie from the attributes of its <div class="react-component"> tag (None if the tag lacks the link or details endpoint)
+def movie_from_attributes(target_link, details_endpoint, poster_url, full_display_name):
+    if not (target_link and details_endpoint):
+        return None
+
+    # Use full display name if available, otherwise extract from target_link
+    if full_display_name:
+        name = full_display_name
+    else:
+        # Extract name from target_link (e.g., "/film/babel-2006/" -> "babel-2006")
+        name = target_link.strip('/').split('/')[-1].replace('-', ' ').title()
+    
+    # Build full URLs
+    url = "https://letterboxd.com" + target_link
+    json_endpoint = details_endpoint  # This already includes the path
+    
+    # Get poster URL
+    if poster_url:
+        poster = "https://letterboxd.com" + poster_url
+    else:
+        # Fallback poster
+        poster = f"https://letterboxd.com{target_link}image-150/"
+    
+    return Movie(name, poster, url, json_endpoint)
 
-        # Break if the page does not exist (end of the watchlist pages)
-        if response.status_code != 200:
-            break  # Stop if the page doesn't exist
+# Reads the total number of watchlist pages from the pagination block (None if the block is missing)
+def get_page_count(soup):
+    page_numbers = []
+    for page in soup.select('div.paginate-pages li.paginate-page'):
+        text = page.get_text(strip=True).replace(',', '')
+        if text.isdigit():
+            page_numbers.append(int(text))
 
-        # Load the html file
-        soup = BeautifulSoup(response.text, 'html.parser')
-            
-        # Get the grid containing all the movies in the page
-        grid_list = soup.find_all('ul', class_='grid')
+    return max(page_numbers) if page_numbers else None
 
-        # Break when no movies are found on the page
-        if not grid_list:
-            break 
+# Extracts the movies from a watchlist page by building the full BeautifulSoup tree
+def _parse_watchlist_page_soup(html):
+    movies = []
 
-        movies_found_this_page = 0
+    # Load the html file
+    soup = BeautifulSoup(html, 'html.parser')
         
-        # Within the grid, each <li> is a movie, and the <div> tag contains the attributes we are interested in
-        for grid in grid_list:
-            li_items = grid.find_all('li', class_='griditem')
-            for li in li_items:
-                div = li.find('div', class_='react-component')
-                if div:
-                    # Extract movie data using the correct attribute names
-                    target_link = div.get('data-target-link')
-                    details_endpoint = div.get('data-details-endpoint')
-                    poster_url = div.get('data-poster-url')
-                    full_display_name = div.get('data-item-full-display-name')
-                    
-                    if target_link and details_endpoint:
-                        # Use full display name if available, otherwise extract from target_link
-                        if full_display_name:
-                            name = full_display_name
-                        else:
-                            # Extract name from target_link (e.g., "/film/babel-2006/" -> "babel-2006")
-                            name = target_link.strip('/').split('/')[-1].replace('-', ' ').title()
-                        
-                        # Build full URLs
-                        url = "https://letterboxd.com" + target_link
-                        json_endpoint = details_endpoint  # This already includes the path
-                        
-                        # Get poster URL
-                        if poster_url:
-                            poster = "https://letterboxd.com" + poster_url
-                        else:
-                            # Fallback poster
-                            poster = f"https://letterboxd.com{target_link}image-150/"
-                        
-                        movie = Movie(name, poster, url, json_endpoint)
-                        movies.append(movie)
-                        movies_found_this_page += 1
-                
-        # Break if no movies were found on this page
-        if movies_found_this_page == 0:
-            break
+    # Get the grid containing all the movies in the page
+    grid_list = soup.find_all('ul', class_='grid')
+
+    # No movies are found on the page
+    if not grid_list:
+        return None, get_page_count(soup)
+
+    # Within the grid, each <li> is a movie, and the <div> tag contains the attributes we are interested in
+    for grid in grid_list:
+        li_items = grid.find_all('li', class_='griditem')
+        for li in li_items:
+            div = li.find('div', class_='react-component')
+            if div:
+                # Extract movie data using the correct attribute names
+                movie = movie_from_attributes(div.get('data-target-link'), div.get('data-details-endpoint'),
+                                              div.get('data-poster-url'), div.get('data-item-full-display-name'))
+                if movie:
+                    movies.append(movie)
+
+    return movies, get_page_count(soup)
+
+class _WatchlistPageExtractor(HTMLParser):
+    '''
+    - Reads the same tags as the BeautifulSoup parser (ul.grid > li.griditem > div.react-component, and the pagination block) as the html is tokenized, without building a tree.
+    - Only the first div.react-component of each li.griditem is used, like li.find() does.
+    - A li.griditem without its </li> ends where the next item of the grid starts (or with the grid), as HTML's implied end tags do.
+    '''
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.found_grid = False
+        self.movies = []
+        self.page_numbers = []
+        self._grid_depth = 0        # Open <ul> tags since entering a ul.grid
+        self._item_depth = 0        # Open <li> tags since entering a li.griditem
+        self._item_done = False     # The current li.griditem already had its div.react-component
+        self._item_lists = 0        # Open <ul>/<ol> tags inside the current li.griditem
+        self._pagination_depth = 0  # Open <div> tags since entering a div.paginate-pages
+        self._page_text = None      # Text of the current li.paginate-page
+
+    def _end_item(self):
+        self._item_depth = 0
+        self._item_lists = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('ul', 'ol') and self._item_depth:
+            self._item_lists += 1
+
+        if tag == 'ul':
+            if self._grid_depth:
+                self._grid_depth += 1
+            elif 'grid' in _classes(attrs):
+                self.found_grid = True
+                self._grid_depth = 1
+
+        elif tag == 'li':
+            if self._item_depth and not self._item_lists:
+                # A sibling of the current item: the current one ends here
+                self._end_item()
+
+            if self._item_depth:
+                self._item_depth += 1
+            elif self._grid_depth and 'griditem' in _classes(attrs):
+                self._item_depth = 1
+                self._item_done = False
+            elif self._pagination_depth and 'paginate-page' in _classes(attrs):
+                self._page_text = []
+
+        elif tag == 'div':
+            if self._item_depth and not self._item_done and 'react-component' in _classes(attrs):
+                self._item_done = True
+                attrs = dict(attrs)
+                movie = movie_from_attributes(attrs.get('data-target-link'), attrs.get('data-details-endpoint'),
+                                              attrs.get('data-poster-url'), attrs.get('data-item-full-display-name'))
+                if movie:
+                    self.movies.append(movie)
+            elif self._pagination_depth:
+                self._pagination_depth += 1
+            elif 'paginate-pages' in _classes(attrs):
+                self._pagination_depth = 1
+
+    def handle_endtag(self, tag):
+        if tag in ('ul', 'ol') and self._item_depth:
+            if self._item_lists:
+                self._item_lists -= 1
+            elif tag == 'ul':
+                # The grid ends with its last item still open
+                self._end_item()
+
+        if tag == 'ul' and self._grid_depth:
+            self._grid_depth -= 1
+        elif tag == 'li':
+            if self._item_depth:
+                self._item_depth -= 1
+            elif self._page_text is not None:
+                text = ''.join(self._page_text).strip().replace(',', '')
+                if text.isdigit():
+                    self.page_numbers.append(int(text))
+                self._page_text = None
+        elif tag == 'div' and self._pagination_depth:
+            self._pagination_depth -= 1
+
+    def handle_data(self, data):
+        if self._page_text is not None:
+            self._page_text.append(data)
+
+def _classes(attrs):
+    for name, value in attrs:
+        if name == 'class':
+            return (value or '').split()
+    return ()
+
+# Extracts the movies from a watchlist page by streaming through its tags
+def _parse_watchlist_page_stream(html):
+    extractor = _WatchlistPageExtractor()
+    extractor.feed(html)
+    extractor.close()
+
+    page_count = max(extractor.page_numbers) if extractor.page_numbers else None
+
+    # No movies are found on the page
+    if not extractor.found_grid:
+        return None, page_count
+
+    return extractor.movies, page_count
+
+PARSER_ENGINES = {
+    'stream': _parse_watchlist_page_stream,
+    'soup': _parse_watchlist_page_soup,
+}
+
+# Extracts the movies and page count from the html of a watchlist page (movies is None if the page has no movie grid)
+def parse_watchlist_page(html, engine=None):
+    engine = engine or PARSER_ENGINE
+    with metrics.timer('randmov_watchlist_page_parse_seconds', engine=engine):
+        return PARSER_ENGINES[engine](html)
+
+# Fetches and parses a single watchlist page (None if the page does not exist or has no movies)
+def _fetch_and_parse_page(username, watchlist_page):
+    html = fetch_watchlist_page(username, watchlist_page)
+    if html is None:
+        return None, None
+
+    return parse_watchlist_page(html)
+
+# Yields the movies of each watchlist page, in watchlist order, as soon as the page is available
+def iter_watchlist_pages(username, workers=None, cancel=None):
+
+    if workers is None:
+        workers = WATCHLIST_WORKERS
+
+    # The first page is always needed, and tells us how many pages there are
+    first_page_movies, page_count = _fetch_and_parse_page(username, 1)
+    if not first_page_movies:
+        return
+
+    yield first_page_movies
+
+    if workers <= 1:
+        # Serial mode: fetch one page after the other until one is missing or empty
+        watchlist_page = 2
+        while not (cancel and cancel.is_set()):
+            page_movies, _ = _fetch_and_parse_page(username, watchlist_page)
+            if not page_movies:
+                break
+            yield page_movies
+            watchlist_page += 1
+        return
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        if page_count is not None:
+            # The pagination block tells us every page there is, so fetch the rest all at once
+            remaining = [executor.submit(_fetch_and_parse_page, username, page) for page in range(2, page_count + 1)]
+            for future in remaining:
+                page_movies, _ = future.result()
+
+                # Keep the original behaviour of stopping at the first missing or empty page
+                if not page_movies or (cancel and cancel.is_set()):
+                    break
+                yield page_movies
+
+        else:
+            # No pagination block: probe ahead in windows of pages until a missing or empty page shows up.
+            # The window starts at a single page (most watchlists without pagination only have one page) and doubles up to the worker count
+            watchlist_page = 2
+            window_size = 1
+            reached_end = False
+            while not reached_end:
+                window = [executor.submit(_fetch_and_parse_page, username, page) for page in range(watchlist_page, watchlist_page + window_size)]
+                for future in window:
+                    page_movies, _ = future.result()
+                    if not page_movies or (cancel and cancel.is_set()):
+                        reached_end = True
+                        break
+                    yield page_movies
 
-        # Check if there are more pages in the watchlist
+                watchlist_page += window_size
+                window_size = min(window_size * 2, workers)
+    finally:
+        # Runs when the pages run out, and also when the caller stops iterating early: pages that have not started yet are cancelled
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def fetch_watchlist_iter(username, workers=None, cancel=None):
+    '''
+    - Yields the movies of the username's watchlist one by one, in watchlist order, as each page arrives (the first ones after a single page fetch).
+    - Stop iterating, close the generator or set the "cancel" event to stop early: the pages that have not started downloading are cancelled.
+    '''
+    for page_movies in iter_watchlist_pages(username, workers, cancel):
+        yield from page_movies
+
+# Retrieves the username's watchlist
+def fetch_watchlist(username, workers=None):
+    return list(fetch_watchlist_iter(username, workers))
+
+# Fetches a watchlist page, conditionally when the validators (ETag/Last-Modified) of an earlier fetch are given: (movies, page count, validators)
+# Movies is None when Letterboxd answers that the page did not change, and an empty list when the page does not exist or has no movies (raises when throttled)
+def _fetch_page_conditionally(username, watchlist_page, validators=None):
+    validators = validators or {}
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+
+    with metrics.timer('randmov_watchlist_page_fetch_seconds'):
+        response = letterboxd_http.get(f"/{username}/watchlist/page/{watchlist_page}", timeout=(5, 10), endpoint='watchlist_page', headers=headers)
+    if response.status_code == 304:
+        return None, None, validators
+    if response.status_code >= 500:
+        response.raise_for_status()
+    if response.status_code != 200:
+        return [], None, {}
+
+    new_validators = {}
+    if response.headers.get('ETag'):
+        new_validators['etag'] = response.headers['ETag']
+    if response.headers.get('Last-Modified'):
+        new_validators['last_modified'] = response.headers['Last-Modified']
+
+    page_movies, page_count = parse_watchlist_page(response.text)
+    return page_movies or [], page_count, new_validators
+
+# Checks a refreshed watchlist against the page count and last page of the watchlist on Letterboxd: the validators of the last page (None if they disagree)
+def _check_last_page(username, movies, page_count, page_size, watchlist_page, page_movies, page_validators):
+    # A single page holds the whole watchlist
+    if page_count is None or page_count == 1:
+        if watchlist_page == 1 and [movie.url for movie in movies] == [movie.url for movie in page_movies]:
+            return page_validators
+        return None
+
+    if not (page_count - 1) * page_size < len(movies) <= page_count * page_size:
+        return None
+
+    # Any movie removed from the cached part shifts the movies of the last page
+    if watchlist_page != page_count:
+        page_movies, _, page_validators = _fetch_page_conditionally(username, page_count)
+
+    if [movie.url for movie in movies[(page_count - 1) * page_size:]] != [movie.url for movie in page_movies]:
+        return None
+
+    return page_validators
+
+# Brings a previously fetched watchlist up to date by fetching only its first pages (watchlists list the newest additions first)
+def refresh_watchlist(username, cached_movies, validators=None, workers=None):
+    '''
+    - "cached_movies" is the watchlist as fetched earlier, and "validators" what the previous refresh returned (None or {} after a full fetch).
+    - Page 1 is requested conditionally (ETag/Last-Modified). When it did not change, no movie was added, and the last page is requested conditionally
+      too to make sure none was removed: when both are unchanged, the cached watchlist is returned as is.
+    - Otherwise pages are fetched from the front until a movie of the cached watchlist shows up, and the new movies are put in front of the cached ones from that movie on.
+    - The result is checked against the page count and the last page of the watchlist; when they disagree (e.g. movies were removed), the whole watchlist is fetched again.
+    - Returns the movies and the validators to pass to the next refresh. Usually takes two requests.
+    '''
+    validators = validators or {}
+    page_movies, page_count, first_validators = _fetch_page_conditionally(username, 1, validators.get('first'))
+
+    if page_movies is None:
+        last_page = validators.get('last_page', 1)
+        if last_page == 1:
+            return list(cached_movies), validators
+
+        last_movies, _, _ = _fetch_page_conditionally(username, last_page, validators.get('last'))
+        if last_movies is None:
+            return list(cached_movies), validators
+
+        # Movies were removed: resync the whole watchlist
+        return fetch_watchlist(username, workers), {}
+
+    if not page_movies:
+        return [], {}
+    page_size = len(page_movies)
+
+    positions = {movie.url: position for position, movie in enumerate(cached_movies)}
+    new_movies = []
+    watchlist_page = 1
+    page_validators = first_validators
+    while page_movies:
+        for movie in page_movies:
+            if movie.url not in positions:
+                new_movies.append(movie)
+                continue
+
+            # First movie already known: the rest of the watchlist is the cached one from there on
+            movies = new_movies + list(cached_movies[positions[movie.url]:])
+            last_validators = _check_last_page(username, movies, page_count, page_size, watchlist_page, page_movies, page_validators)
+            if last_validators is None:
+                # The counts disagree: resync the whole watchlist
+                return fetch_watchlist(username, workers), {}
+
+            return movies, {'first': first_validators, 'last': last_validators, 'last_page': page_count or 1}
+
+        if page_count is not None and watchlist_page >= page_count:
+            break
+        next_movies, _, next_validators = _fetch_page_conditionally(username, watchlist_page + 1)
+        if not next_movies:
+            break
         watchlist_page += 1
-    return movies
+        page_movies, page_validators = next_movies, next_validators
+
+    # None of the cached movies is left, so every page has been fetched already
+    return new_movies, {'first': first_validators, 'last': page_validators, 'last_page': watchlist_page}
+
+# Picks a random movie from the whole watchlist, fetching every page ((None, None) if the watchlist is empty)
+def _pick_from_whole_watchlist(username):
+    movies = fetch_watchlist(username)
+    if not movies:
+        return None, None
+    random_index_instance = qrng(len(movies) - 1)
+    return movies[random_index_instance.random_number], random_index_instance
+
+# Picks a random movie without fetching the whole watchlist: page 1 gives the page count and page size, and only the page holding the chosen movie is fetched
+def fetch_random_movie(username):
+    '''
+    - Returns the chosen movie and the QuantumRandomNumber used to choose it ((None, None) if the watchlist is empty).
+    - The number is drawn over "page count x page size" positions. The last page is usually shorter: a number past its end is rejected and drawn again
+      (over the exact number of movies, now known), so every movie stays equally likely.
+    - Usually takes two requests (page 1 and the chosen page); a rejection on the last page can add one more.
+    - When page 1 has no pagination block, the page count is unknown and the whole watchlist is fetched instead.
+    '''
+    first_page_movies, page_count = _fetch_and_parse_page(username, 1)
+    if not first_page_movies:
+        return None, None
+
+    # Without a pagination block the page count is unknown (the watchlist may still have more pages), so pick from the whole watchlist
+    if page_count is None:
+        return _pick_from_whole_watchlist(username)
+
+    page_size = len(first_page_movies)
+    pages = {1: first_page_movies}
+    total = page_size * page_count  # Upper bound until the last page has been seen
+
+    while True:
+        random_index_instance = qrng(total - 1)
+        page, position = divmod(random_index_instance.random_number, page_size)
+        page += 1
+
+        if page not in pages:
+            page_movies, _ = _fetch_and_parse_page(username, page)
+            pages[page] = page_movies or []
+
+        if position < len(pages[page]):
+            return pages[page][position], random_index_instance
+
+        if page != page_count:
+            # Only the last page can be short: the watchlist changed between requests, so pick from the whole watchlist instead
+            return _pick_from_whole_watchlist(username)
+
+        # Now the length of the last page is known
+        total = page_size * (page_count - 1) + len(pages[page])
 
 def get_random_movie(movies):
     random_index_instance = qrng(len(movies) - 1)
     random_movie = movies[random_index_instance.random_number]
     
+    return print_random_movie(random_movie, random_index_instance)
+
+def print_random_movie(random_movie, random_index_instance):
     return print(f'\n\nYour random movie is: {random_movie.name} ({random_movie.url}). \n\nIt was chosen using this quantum circuit:\n{random_index_instance.qc.draw('text')}')
 
+def get_random_movies(movies, k):
+    # Draw k different movies, in order, from a single batched quantum simulation
+    random_sample = qrng_many(len(movies) - 1, min(k, len(movies)))
+    random_movies = [movies[i] for i in random_sample.random_numbers]
+
+    movie_lines = '\n'.join(f'{position}. {movie.name} ({movie.url})' for position, movie in enumerate(random_movies, start=1))
+    return print(f'\n\nYour random movies are:\n{movie_lines}\n\nThey were chosen using this quantum circuit:\n{random_sample.qc.draw("text")}')
+
 def main():
     # Ask user for username
     username = input('Enter your Letterboxd username: ')
 
+    # Ask how many movies to pick (0 shuffles the whole watchlist into a queue)
+    pick_count = input('How many random movies do you want? (press Enter for 1, 0 to shuffle the whole watchlist): ').strip()
+    pick_count = int(pick_count) if pick_count.isdigit() else 1
+
     # Start spinner
     stop_spinner = threading.Event()
     print()
     spinner_thread = threading.Thread(target=spinner, args=("Working on your watchlist...", stop_spinner))
     spinner_thread.start()
 
-    # Show all movies in the watchlist for the given username
-    movies = fetch_watchlist(username)
+    # A single movie only needs the page it is on, not the whole watchlist
+    if pick_count == 1:
+        random_movie, random_index_instance = fetch_random_movie(username)
+        if random_movie:
+            print_random_movie(random_movie, random_index_instance)
+        else:
+            print('\n\nNo movies found for this user.')
+
+    else:
+        # Show all movies in the watchlist for the given username
+        movies = fetch_watchlist(username)
 
-    for movie in movies:
-        print(movie.json)
+        for movie in movies:
+            print(movie.json)
 
-    # Uncomment this section if want to see the user's entire watchlist
-    #print(f'\n\nThis is your watchlist ({len(movies)} movies in total):')
-    #for movie in movies:
-    #   print(f"- {movie.name} ({movie.url})")
+        # Uncomment this section if want to see the user's entire watchlist
+        #print(f'\n\nThis is your watchlist ({len(movies)} movies in total):')
+        #for movie in movies:
+        #   print(f"- {movie.name} ({movie.url})")
 
-    # Output a random movie
-    random_mov = get_random_movie(movies)
+        # Output several random movies
+        random_mov = get_random_movies(movies, pick_count or len(movies))
 
     # Stop spinner
     stop_spinner.set()
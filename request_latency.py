@@ -0,0 +1,121 @@
+import os
+import threading
+from collections import deque
+import metrics
+
+# Recent latencies of the requests sent to Letterboxd, by endpoint (watchlist pages, movie details), used by letterboxd_http.get to cut tail latency:
+# - adaptive timeouts: the read timeout follows the recent p99 (times TIMEOUT_MULTIPLIER) instead of a fixed 10s, so a stuck request is retried sooner
+# - hedging (opt-in): when a request takes longer than the recent p95, a duplicate is sent and the first answer wins; hedges are capped by a budget
+
+# Set RANDMOV_ADAPTIVE_TIMEOUTS=0 to always use the fixed timeouts of the callers
+ADAPTIVE_TIMEOUTS = os.environ.get('RANDMOV_ADAPTIVE_TIMEOUTS', '1') == '1'
+
+# Read timeout = recent p99 x this, never below MIN_TIMEOUT seconds nor above the caller's timeout
+TIMEOUT_MULTIPLIER = float(os.environ.get('RANDMOV_TIMEOUT_MULTIPLIER', 3))
+MIN_TIMEOUT = float(os.environ.get('RANDMOV_MIN_TIMEOUT', 2))
+
+# Set RANDMOV_HEDGE=1 to send a duplicate of the requests slower than the recent p95
+HEDGING_ENABLED = os.environ.get('RANDMOV_HEDGE', '') == '1'
+
+# Hedges allowed per request sent (0.1: at most 10% more requests), and how many can be saved up for a burst of slow requests
+HEDGE_BUDGET = float(os.environ.get('RANDMOV_HEDGE_BUDGET', 0.1))
+HEDGE_BUDGET_BURST = 10
+
+# Latencies kept per endpoint, and how many are needed before the percentiles are used
+WINDOW_SIZE = 500
+MIN_SAMPLES = 50
+
+class LatencyWindow():
+    '''
+    - Keeps the last WINDOW_SIZE latencies (seconds) of an endpoint and gives their percentiles.
+    - Safe to use from multiple threads.
+    '''
+    def __init__(self, size=WINDOW_SIZE):
+        self._latencies = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, fraction):
+        """Nearest-rank percentile of the recent latencies (None until MIN_SAMPLES were recorded)"""
+        with self._lock:
+            if len(self._latencies) < MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+class HedgeBudget():
+    '''
+    - Token budget of the hedged requests: every request sent adds HEDGE_BUDGET tokens (up to HEDGE_BUDGET_BURST), every hedge takes one.
+    - So hedges never add more than HEDGE_BUDGET of extra load, even when Letterboxd slows down for every request.
+    '''
+    def __init__(self, ratio=HEDGE_BUDGET, burst=HEDGE_BUDGET_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def try_spend(self):
+        """Take a token for a hedge (False when the budget is used up)"""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+_windows = {}
+_windows_lock = threading.Lock()
+hedge_budget = HedgeBudget()
+
+def get_window(endpoint):
+    """Return the latency window of an endpoint, creating it on first use"""
+    window = _windows.get(endpoint)
+    if window is None:
+        with _windows_lock:
+            window = _windows.setdefault(endpoint, LatencyWindow())
+    return window
+
+def record(endpoint, latency):
+    """Record the latency (seconds) of a request that got an answer"""
+    get_window(endpoint).record(latency)
+    metrics.observe('randmov_http_upstream_seconds', latency, endpoint=endpoint)
+
+def adaptive_timeout(endpoint, timeout):
+    """The caller's timeout (seconds, or a (connect, read) tuple) with the read timeout lowered to the endpoint's recent p99 x TIMEOUT_MULTIPLIER"""
+    if not ADAPTIVE_TIMEOUTS:
+        return timeout
+
+    p99 = get_window(endpoint).percentile(0.99)
+    if p99 is None:
+        return timeout
+
+    connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (None, timeout)
+    read_timeout = min(read_timeout, max(MIN_TIMEOUT, p99 * TIMEOUT_MULTIPLIER))
+    return (connect_timeout, read_timeout) if connect_timeout is not None else read_timeout
+
+def hedge_delay(endpoint):
+    """Seconds after which a request to the endpoint is hedged: its recent p95 (None when hedging is off or there are too few latencies yet)"""
+    if not HEDGING_ENABLED:
+        return None
+    return get_window(endpoint).percentile(0.95)
+
+def collect_latency_metrics():
+    """Current read timeout and hedging threshold of every endpoint"""
+    with _windows_lock:
+        endpoints = list(_windows)
+
+    for endpoint in endpoints:
+        p99 = get_window(endpoint).percentile(0.99)
+        if ADAPTIVE_TIMEOUTS and p99 is not None:
+            yield 'randmov_http_adaptive_timeout_seconds', {'endpoint': endpoint}, max(MIN_TIMEOUT, p99 * TIMEOUT_MULTIPLIER)
+        p95 = get_window(endpoint).percentile(0.95)
+        if p95 is not None:
+            yield 'randmov_http_latency_p95_seconds', {'endpoint': endpoint}, p95
+
+metrics.register_collector(collect_latency_metrics)
@@ -0,0 +1,142 @@
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from datetime import datetime
+from functools import wraps
+from details_cache import DATA_DIR
+
+# Opt-in profiling of individual requests: the views wrapped with @profiled run under cProfile when the request asks for it
+# (with the X-RandMov-Profile header) or is sampled, and each profile is saved to a bounded ring of files listed by the app's /admin/profiles route.
+# When RANDMOV_PROFILE is not set, @profiled returns the view unchanged, so there is no overhead at all.
+
+# The header must carry this value and the admin routes require it (?token=...)
+PROFILE_TOKEN = os.environ.get('RANDMOV_PROFILE_TOKEN', '')
+
+# Profiles show the app's internals, so profiling is only enabled along with a token
+PROFILING_ENABLED = os.environ.get('RANDMOV_PROFILE', '') == '1' and bool(PROFILE_TOKEN)
+if os.environ.get('RANDMOV_PROFILE', '') == '1' and not PROFILE_TOKEN:
+    print("Profiling disabled: RANDMOV_PROFILE=1 also needs RANDMOV_PROFILE_TOKEN")
+
+# Fraction of the requests profiled without asking (0 only profiles the requests sending the header)
+PROFILE_SAMPLE_RATE = float(os.environ.get('RANDMOV_PROFILE_SAMPLE_RATE', 0))
+
+PROFILE_HEADER = 'X-RandMov-Profile'
+
+# Directory of the saved profiles, and how many are kept (the oldest ones are deleted first)
+PROFILE_DIR = os.environ.get('RANDMOV_PROFILE_DIR', os.path.join(DATA_DIR, 'profiles'))
+PROFILE_MAX_FILES = int(os.environ.get('RANDMOV_PROFILE_MAX_FILES', 50))
+
+# Only one request is profiled at a time per process (Python allows a single active profiler)
+_profiling_lock = threading.Lock()
+
+def _token_matches(value):
+    # Compared as bytes: compare_digest only takes ASCII strings, and the value comes from the client
+    return bool(value) and hmac.compare_digest(value.encode(), PROFILE_TOKEN.encode())
+
+def authorized(value):
+    """Whether a header value asks for a profile (it must be the configured token)"""
+    return PROFILING_ENABLED and _token_matches(value)
+
+def admin_authorized(token):
+    """Whether the admin routes can be used with this token"""
+    return PROFILING_ENABLED and _token_matches(token)
+
+def _wants_profile(request):
+    if authorized(request.headers.get(PROFILE_HEADER)):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def save_profile(profile, duration, request, status):
+    """Write the profile and what request it belongs to, then drop the oldest profiles beyond PROFILE_MAX_FILES"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f'{datetime.now().strftime("%Y%m%d-%H%M%S-%f")}-{request.endpoint or "unknown"}'
+
+    profile.dump_stats(os.path.join(PROFILE_DIR, name + '.prof'))
+    with open(os.path.join(PROFILE_DIR, name + '.json'), 'w', encoding='utf-8') as f:
+        json.dump({
+            'name': name,
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'path': request.path,
+            'status': status,
+            'duration_ms': round(duration * 1000, 1),
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+        }, f)
+
+    names = sorted(file_name[:-len('.json')] for file_name in os.listdir(PROFILE_DIR) if file_name.endswith('.json'))
+    for old_name in names[:max(0, len(names) - PROFILE_MAX_FILES)]:
+        for extension in ('.prof', '.json'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, old_name + extension))
+            except FileNotFoundError:
+                pass
+
+def list_profiles(limit=20):
+    """Saved profiles, slowest request first"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+
+    profiles = []
+    for file_name in os.listdir(PROFILE_DIR):
+        if file_name.endswith('.json'):
+            try:
+                with open(os.path.join(PROFILE_DIR, file_name), encoding='utf-8') as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"Error reading profile {file_name}: {e}")
+
+    profiles.sort(key=lambda profile: profile['duration_ms'], reverse=True)
+    return profiles[:limit]
+
+def profile_path(name):
+    """Path of a saved profile (None if the name is not one of the saved profiles)"""
+    path = os.path.join(PROFILE_DIR, os.path.basename(name) + '.prof')
+    return path if os.path.isfile(path) else None
+
+def format_profile(name, sort='cumulative', limit=40):
+    """The functions of a saved profile as pstats text (None if it does not exist)"""
+    path = profile_path(name)
+    if path is None:
+        return None
+
+    output = io.StringIO()
+    pstats.Stats(path, stream=output).strip_dirs().sort_stats(sort).print_stats(limit)
+    return output.getvalue()
+
+def profiled(view):
+    '''
+    - Decorator for Flask views: the request runs under cProfile when it sends the X-RandMov-Profile header or is sampled (RANDMOV_PROFILE_SAMPLE_RATE).
+    - Only the view itself is profiled (for a streamed page, up to the first chunk).
+    - Returns the view unchanged when profiling is disabled.
+    '''
+    if not PROFILING_ENABLED:
+        return view
+
+    from flask import request, make_response
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not _wants_profile(request) or not _profiling_lock.acquire(blocking=False):
+            return view(*args, **kwargs)
+
+        try:
+            profile = cProfile.Profile()
+            started = time.perf_counter()
+            response = make_response(profile.runcall(view, *args, **kwargs))
+            duration = time.perf_counter() - started
+
+            try:
+                save_profile(profile, duration, request, response.status_code)
+            except OSError as e:
+                print(f"Error saving profile: {e}")
+            return response
+        finally:
+            _profiling_lock.release()
+
+    return wrapper
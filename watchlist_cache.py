@@ -0,0 +1,245 @@
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+import metrics
+from details_cache import DATA_DIR, connect_database
+from randmov_html_parser import Movie
+
+# Short-lived cache of scraped watchlists, keyed by username and shared by every gunicorn worker process (SQLite, next to the details cache).
+# Fetches are single-flight: while a watchlist is being scraped, other requests for it (in this process or in another worker) wait for that scrape
+# instead of starting their own.
+
+# Seconds a scraped watchlist is served from the cache
+WATCHLIST_CACHE_TTL = int(os.environ.get('RANDMOV_WATCHLIST_CACHE_TTL', 300))
+
+# Seconds an expired watchlist is still kept, so the next load only has to fetch its newest pages (see randmov_html_parser.refresh_watchlist)
+WATCHLIST_CACHE_RETENTION = int(os.environ.get('RANDMOV_WATCHLIST_CACHE_RETENTION', 7 * 24 * 3600))
+
+# Seconds a worker may spend scraping a watchlist before other workers stop waiting for it and scrape it themselves
+WATCHLIST_FETCH_LEASE = int(os.environ.get('RANDMOV_WATCHLIST_FETCH_LEASE', 120))
+
+# Seconds between two checks of the cache while another worker scrapes the watchlist
+WAIT_INTERVAL = 0.2
+
+class WatchlistFetch():
+    '''
+    - A scrape of a watchlist that other requests may be waiting on, returned by WatchlistCache.begin_fetch.
+    - The request doing the scrape must end it with finish(movies) or fail(), which wakes up the waiting requests.
+    '''
+    def __init__(self, cache, username, owner):
+        self.cache = cache
+        self.username = username
+        self.owner = owner  # Lease owner in the database (None when the lease could not be written)
+        self.movies = None
+        self.done = threading.Event()
+
+    def finish(self, movies, validators=None):
+        """Store the scraped watchlist (and the validators of its first page) in the cache and hand it to the waiting requests"""
+        self.movies = list(movies)
+        # An empty result may come from a failed scrape, so it is only handed to the requests already waiting
+        if self.movies:
+            self.cache.set(self.username, self.movies, validators)
+        self._end()
+
+    def fail(self):
+        """End the scrape without a result (the waiting requests then scrape the watchlist themselves)"""
+        self._end()
+
+    def _end(self):
+        if self.done.is_set():
+            return
+        self.cache._end_fetch(self)
+        self.done.set()
+
+class WatchlistCache():
+    '''
+    - Stores the movies of each scraped watchlist for "ttl" seconds, in a SQLite database every worker process can read.
+    - get_or_fetch(username, fetch, refresh) returns the cached watchlist, waits for a scrape already in flight (in any worker), or scrapes it once.
+    - Expired watchlists are kept for "retention" seconds as the base of an incremental refresh, along with the ETag/Last-Modified of their first page.
+    - Requests that stream the watchlist as it arrives use begin_fetch/WatchlistFetch to let other requests wait on their scrape.
+    - Database errors are printed and treated as cache misses, so the app keeps working (without sharing) if the database is unavailable.
+    '''
+    def __init__(self, path=None, ttl=WATCHLIST_CACHE_TTL, lease=WATCHLIST_FETCH_LEASE, retention=WATCHLIST_CACHE_RETENTION):
+        self.path = path or os.path.join(DATA_DIR, 'watchlist_cache.sqlite3')
+        self.ttl = ttl
+        self.retention = max(retention, ttl)
+        self.lease = lease
+        self._local = threading.local()
+        self._fetches = {}  # Scrapes in flight in this process, by cache key
+        self._fetches_lock = threading.Lock()
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = connect_database(self.path)
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS watchlists (
+                    username TEXT PRIMARY KEY,
+                    movies TEXT NOT NULL,
+                    stored_at REAL NOT NULL,
+                    validators TEXT
+                )
+            ''')
+            # Databases created before validators were stored
+            if 'validators' not in [column[1] for column in connection.execute('PRAGMA table_info(watchlists)')]:
+                connection.execute('ALTER TABLE watchlists ADD COLUMN validators TEXT')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS watchlist_fetches (
+                    username TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    started_at REAL NOT NULL
+                )
+            ''')
+            self._local.connection = connection
+
+        return connection
+
+    @staticmethod
+    def _key(username):
+        # Letterboxd usernames are not case sensitive
+        return username.strip().lower()
+
+    def _read(self, username, max_age, columns):
+        # The row of a watchlist stored less than "max_age" seconds ago (None if missing, older or on database errors)
+        try:
+            return self._connect().execute(
+                f'SELECT {columns} FROM watchlists WHERE username = ? AND stored_at > ?', (self._key(username), time.time() - max_age)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Watchlist cache error: {e}")
+            return None
+
+    def get(self, username):
+        """Return the cached movies of a watchlist (None if missing or expired)"""
+        row = self._read(username, self.ttl, 'movies')
+        metrics.inc('randmov_cache_requests_total', cache='watchlist', result='miss' if row is None else 'hit')
+        if row is None:
+            return None
+
+        return [Movie(*fields) for fields in json.loads(row[0])]
+
+    def get_previous(self, username):
+        """Return the movies and first page validators of the last scrape of a watchlist, even if expired (None if not kept)"""
+        row = self._read(username, self.retention, 'movies, validators')
+        if row is None:
+            return None
+
+        return [Movie(*fields) for fields in json.loads(row[0])], json.loads(row[1] or '{}')
+
+    def has_previous(self, username):
+        """Whether an earlier scrape of the watchlist is kept (so loading it again only needs an incremental refresh)"""
+        return self._read(username, self.retention, '1') is not None
+
+    def set(self, username, movies, validators=None):
+        """Store the movies of a watchlist, and the validators (ETag/Last-Modified) of its first page"""
+        now = time.time()
+        try:
+            connection = self._connect()
+            connection.execute(
+                'INSERT OR REPLACE INTO watchlists (username, movies, stored_at, validators) VALUES (?, ?, ?, ?)',
+                (self._key(username), json.dumps([(movie.name, movie.poster, movie.url, movie.json) for movie in movies]), now, json.dumps(validators or {})),
+            )
+            connection.execute('DELETE FROM watchlists WHERE stored_at < ?', (now - self.retention,))
+        except sqlite3.Error as e:
+            print(f"Watchlist cache error: {e}")
+
+    def begin_fetch(self, username):
+        '''
+        - Returns a WatchlistFetch when the caller should scrape the watchlist itself (and end the fetch when done).
+        - Returns None when the watchlist is already cached or being scraped by another request, in which case get_or_fetch returns it.
+        '''
+        key = self._key(username)
+        with self._fetches_lock:
+            if key in self._fetches:
+                return None
+            fetch = WatchlistFetch(self, username, None)
+            self._fetches[key] = fetch
+
+        # Another worker may hold the lease, or have just stored the watchlist
+        owner = self._acquire_lease(key)
+        fetch.owner = owner or None
+        if owner is False or self.get(username) is not None:
+            fetch.fail()
+            return None
+
+        return fetch
+
+    def get_or_fetch(self, username, fetch_movies, refresh_movies=None):
+        '''
+        - Returns the movies of the watchlist: from the cache, from the scrape in flight for it (in this process or another worker),
+          or from "fetch_movies(username)", which is then called by a single request at a time.
+        - When an expired scrape of the watchlist is kept and "refresh_movies" is given, "refresh_movies(username, movies, validators)"
+          is called instead of "fetch_movies", and must return the up to date movies and validators.
+        - Waits at most about "lease" seconds for another scrape; if it fails or takes longer, this request scrapes the watchlist itself.
+        '''
+        deadline = time.monotonic() + self.lease
+        while True:
+            movies = self.get(username)
+            if movies is not None:
+                return movies
+
+            # Wait for the scrape in flight in this process
+            with self._fetches_lock:
+                in_flight = self._fetches.get(self._key(username))
+            if in_flight is not None:
+                if in_flight.done.wait(max(0, deadline - time.monotonic())) and in_flight.movies is not None:
+                    return in_flight.movies
+                if time.monotonic() < deadline:
+                    continue
+            else:
+                fetch = self.begin_fetch(username)
+                if fetch is not None:
+                    break
+
+                # Another worker is scraping it: check the cache again shortly
+                if time.monotonic() < deadline:
+                    time.sleep(WAIT_INTERVAL)
+                    continue
+
+            # Waited long enough: scrape it here, without coordination
+            return fetch_movies(username)
+
+        try:
+            previous = self.get_previous(username) if refresh_movies else None
+            if previous is not None:
+                movies, validators = refresh_movies(username, *previous)
+            else:
+                movies, validators = fetch_movies(username), None
+        except Exception:
+            fetch.fail()
+            raise
+
+        fetch.finish(movies, validators)
+        return fetch.movies
+
+    def _acquire_lease(self, key):
+        # Take (or take over an expired) lease on scraping a watchlist: the lease owner, False if another worker holds it, None on database errors
+        owner = f'{os.getpid()}-{secrets.token_hex(8)}'
+        now = time.time()
+        try:
+            cursor = self._connect().execute(
+                '''INSERT INTO watchlist_fetches (username, owner, started_at) VALUES (?, ?, ?)
+                   ON CONFLICT (username) DO UPDATE SET owner = excluded.owner, started_at = excluded.started_at
+                   WHERE watchlist_fetches.started_at < ?''',
+                (key, owner, now, now - self.lease),
+            )
+        except sqlite3.Error as e:
+            print(f"Watchlist cache error: {e}")
+            return None
+
+        return owner if cursor.rowcount == 1 else False
+
+    def _end_fetch(self, fetch):
+        key = self._key(fetch.username)
+        if fetch.owner:
+            try:
+                self._connect().execute('DELETE FROM watchlist_fetches WHERE username = ? AND owner = ?', (key, fetch.owner))
+            except sqlite3.Error as e:
+                print(f"Watchlist cache error: {e}")
+
+        with self._fetches_lock:
+            if self._fetches.get(key) is fetch:
+                del self._fetches[key]
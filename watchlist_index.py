@@ -0,0 +1,81 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+# Index over the details (director, year and runtime) of the movies in a watchlist snapshot, used to pick a random movie among those matching some filters
+
+# Runtime ranges offered by the page's runtime filter, as (lowest, highest) minutes, both included
+RUNTIME_RANGES = {
+    '0-90': (0, 89),
+    '90-120': (90, 120),
+    '120-150': (120, 150),
+    '150+': (150, None),
+}
+
+def decade_of(year):
+    """Name of the decade filter a year belongs to (e.g. 1975 -> "1970s", anything before 1920 -> "pre-1920")"""
+    if year < 1920:
+        return 'pre-1920'
+    return f'{year // 10 * 10}s'
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+class WatchlistIndex():
+    '''
+    - Built from the details summary of each movie of a watchlist (in watchlist order, None for movies without details).
+    - Maps each director and each decade to the set of movie positions, and keeps the positions sorted by runtime to answer runtime ranges.
+    - Movies whose director, year or runtime is unknown never match a filter on that field.
+    '''
+    def __init__(self, summaries):
+        self.size = len(summaries)
+        self.directors = defaultdict(set)
+        self.decades = defaultdict(set)
+        self._runtimes = []  # (runtime, position) sorted by runtime
+
+        for position, summary in enumerate(summaries):
+            if not summary:
+                continue
+
+            director = summary.get('director')
+            if director and director != 'Unknown':
+                self.directors[director].add(position)
+
+            year = _as_int(summary.get('year'))
+            if year is not None:
+                self.decades[decade_of(year)].add(position)
+
+            runtime = _as_int(summary.get('runtime'))
+            if runtime is not None:
+                self._runtimes.append((runtime, position))
+
+        self._runtimes.sort()
+        self._runtime_values = [runtime for runtime, _ in self._runtimes]
+
+    def runtime_between(self, lowest=None, highest=None):
+        """Positions of the movies whose runtime is between "lowest" and "highest" minutes (both included, None for no limit)"""
+        start = bisect_left(self._runtime_values, lowest) if lowest is not None else 0
+        end = bisect_right(self._runtime_values, highest) if highest is not None else len(self._runtimes)
+        return {position for _, position in self._runtimes[start:end]}
+
+    def filter(self, director=None, decade=None, runtime=None, min_runtime=None, max_runtime=None):
+        '''
+        - Returns the sorted positions of the movies matching every given filter (all the movies if no filter is given).
+        - "decade" and "runtime" take the same values as the page's year and runtime filters (e.g. "1970s", "90-120"); "min_runtime"/"max_runtime" set a custom range in minutes.
+        '''
+        matches = set(range(self.size))
+
+        if director:
+            matches &= self.directors.get(director, set())
+        if decade:
+            matches &= self.decades.get(decade, set())
+        if runtime:
+            if runtime not in RUNTIME_RANGES:
+                raise ValueError(f'Unknown runtime range: {runtime}')
+            matches &= self.runtime_between(*RUNTIME_RANGES[runtime])
+        if min_runtime is not None or max_runtime is not None:
+            matches &= self.runtime_between(min_runtime, max_runtime)
+
+        return sorted(matches)
@@ -0,0 +1,83 @@
+import os
+import secrets
+import threading
+import time
+import metrics
+from collections import OrderedDict
+from compact_watchlist import CompactWatchlist
+
+# Server-side store of loaded watchlists, so the selection step can map the submitted indices back to movies without scraping the watchlist again
+
+# Seconds a snapshot is kept after it was last used
+SNAPSHOT_TTL = int(os.environ.get('RANDMOV_SNAPSHOT_TTL', 1800))
+
+# Maximum number of snapshots kept in memory (the least recently used ones are dropped first)
+SNAPSHOT_MAX_ENTRIES = int(os.environ.get('RANDMOV_SNAPSHOT_MAX_ENTRIES', 256))
+
+class WatchlistSnapshot():
+    def __init__(self, token, username, movies):
+        self.token = token
+        self.username = username
+        self.movies = CompactWatchlist(movies)  # Read-only, so indices always point to the movie the user saw
+        self.last_used = time.monotonic()
+        self.index = None  # Index over the details of the movies, built on first use (see app.get_watchlist_index)
+
+    def __str__(self):
+        return f'{self.username} ({len(self.movies)} movies, token {self.token})'
+
+class WatchlistStore():
+    '''
+    - Keeps watchlist snapshots in memory under a random token that is embedded in the selection form.
+    - Snapshots expire "ttl" seconds after they were last used, and at most "max_entries" snapshots are kept (least recently used first out).
+    - Safe to use from multiple threads.
+    '''
+    def __init__(self, ttl=SNAPSHOT_TTL, max_entries=SNAPSHOT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_token():
+        """Return a new random snapshot token (to embed it in a page before its snapshot is stored)"""
+        return secrets.token_urlsafe(16)
+
+    def put(self, username, movies, token=None):
+        """Store a snapshot of the watchlist (under a new token unless one is given) and return it"""
+        snapshot = WatchlistSnapshot(token or self.new_token(), username, movies)
+
+        with self._lock:
+            self._evict_expired()
+            self._snapshots[snapshot.token] = snapshot
+            while len(self._snapshots) > self.max_entries:
+                self._snapshots.popitem(last=False)
+
+        return snapshot
+
+    def get(self, token):
+        """Return the snapshot stored under the token (None if it does not exist or has expired)"""
+        if not token:
+            return None
+
+        with self._lock:
+            self._evict_expired()
+            snapshot = self._snapshots.get(token)
+            if snapshot is not None:
+                snapshot.last_used = time.monotonic()
+                self._snapshots.move_to_end(token)
+
+        metrics.inc('randmov_cache_requests_total', cache='watchlist_snapshot', result='miss' if snapshot is None else 'hit')
+        return snapshot
+
+    def __len__(self):
+        with self._lock:
+            return len(self._snapshots)
+
+    def _evict_expired(self):
+        # Snapshots are kept in least recently used order, so expired ones are always at the front
+        now = time.monotonic()
+        while self._snapshots:
+            token, snapshot = next(iter(self._snapshots.items()))
+            if now - snapshot.last_used < self.ttl:
+                break
+            del self._snapshots[token]